@@ -0,0 +1,204 @@
+from typing import (Union, Optional, Any, List, Set, Dict,
+                    Callable, Awaitable, Hashable, TYPE_CHECKING)
+import logging
+import asyncio
+
+from grpclib.exceptions import GRPCError
+
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+
+from .utils import ensure_bytes
+
+if TYPE_CHECKING:
+    from .client import KVSection
+
+logger = logging.getLogger(__name__)
+
+# the default --max-txn-ops of etcd server
+MAX_TXN_OPS = 128
+
+class WriteBatcher:
+    '''
+    Coalesces the puts and deletes issued concurrently within a small
+    time window into one Txn request, each caller gets the response of
+    its own op.
+
+    A key is written at most once in a batch as etcd rejects duplicate
+    keys in one txn, the batch is committed early on a repeated key.
+    The writes to a key are committed in the order issued, a batch
+    waits for the batches in flight writing its keys.
+    '''
+    kv: 'KVSection'
+    window: float
+    max_ops: int
+    batches: int = 0
+    ops: int = 0
+    _pending_ops: List[pb2.RequestOp]
+    _futures: List[asyncio.Future]
+    _keys: Set[bytes]
+    # the last batch in flight writing each key
+    _committing: Dict[bytes, asyncio.Future]
+    _timer: Optional[asyncio.Handle] = None
+
+    def __init__(self, kv: 'KVSection',
+                 window: float=0.002,
+                 max_ops: int=MAX_TXN_OPS):
+        '''
+        :param window: seconds to wait for more writes after the first
+        one of a batch
+        :param max_ops: the max ops in a batch, which must not exceed
+        the --max-txn-ops of etcd server
+        '''
+        assert max_ops >= 1
+        self.kv = kv
+        self.window = window
+        self.max_ops = max_ops
+        self._pending_ops = []
+        self._futures = []
+        self._keys = set()
+        self._committing = {}
+
+    async def put(self,
+                  key: Union[bytes, str],
+                  value: Union[bytes, str],
+                  lease_id: int=0,
+                  prev_kv: bool=False) -> pb2.PutResponse:
+        key = ensure_bytes(key)
+        op = pb2.RequestOp(
+            request_put=pb2.PutRequest(
+                key=key,
+                value=ensure_bytes(value),
+                lease=lease_id,
+                prev_kv=prev_kv))
+        return await self._submit(key, op)
+
+    async def delete(self,
+                     key: Union[bytes, str],
+                     prev_kv: bool=False) -> pb2.DeleteRangeResponse:
+        key = ensure_bytes(key)
+        op = pb2.RequestOp(
+            request_delete_range=pb2.DeleteRangeRequest(
+                key=key,
+                prev_kv=prev_kv))
+        return await self._submit(key, op)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'batches': self.batches,
+            'ops': self.ops,
+            'pending': len(self._pending_ops),
+        }
+
+    def _submit(self, key: bytes, op: pb2.RequestOp) -> asyncio.Future:
+        if key in self._keys:
+            self.flush()
+        fut = asyncio.get_event_loop().create_future()
+        self._pending_ops.append(op)
+        self._futures.append(fut)
+        self._keys.add(key)
+        if len(self._pending_ops) >= self.max_ops:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.window, self.flush)
+        return fut
+
+    def flush(self) -> None:
+        '''
+        Commit the pending writes now
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending_ops:
+            return
+        ops, futures, keys = self._pending_ops, self._futures, self._keys
+        self._pending_ops = []
+        self._futures = []
+        self._keys = set()
+        self.batches += 1
+        self.ops += len(ops)
+        prev_batches = {self._committing[key] for key in keys
+                        if key in self._committing}
+        task = asyncio.ensure_future(
+            self._commit_after(prev_batches, ops, futures))
+        for key in keys:
+            self._committing[key] = task
+        task.add_done_callback(lambda _: self._forget(keys, task))
+
+    def _forget(self, keys: Set[bytes], task: asyncio.Future) -> None:
+        for key in keys:
+            if self._committing.get(key) is task:
+                del self._committing[key]
+
+    async def _commit_after(self,
+                            prev_batches: Set[asyncio.Future],
+                            ops: List[pb2.RequestOp],
+                            futures: List[asyncio.Future]) -> None:
+        if prev_batches:
+            await asyncio.wait(prev_batches)
+        await self._commit(ops, futures)
+
+    async def _commit(self,
+                      ops: List[pb2.RequestOp],
+                      futures: List[asyncio.Future]) -> None:
+        try:
+            resp = await self.kv.txn(success=ops)
+        except GRPCError as e:
+            if len(ops) == 1:
+                _set_exception(futures[0], e)
+            else:
+                # one bad op fails the whole txn, commit the ops one
+                # by one so that only its caller gets the error
+                logger.info('batch of %s ops failed, %s, commit separately',
+                            len(ops), e)
+                await asyncio.gather(*[
+                    self._commit([op], [fut])
+                    for op, fut in zip(ops, futures)])
+            return
+        except Exception as e:
+            for fut in futures:
+                _set_exception(fut, e)
+            return
+
+        for fut, op_resp in zip(futures, resp.responses):
+            if not fut.done():
+                fut.set_result(
+                    getattr(op_resp, op_resp.WhichOneof('response')))
+
+def _set_exception(fut: asyncio.Future, e: Exception) -> None:
+    if not fut.done():
+        fut.set_exception(e)
+
+class SingleFlight:
+    '''
+    Shares one call in flight among the concurrent callers of the same
+    key, all of them get the same result object.
+    '''
+    calls: int = 0
+    merged: int = 0
+    _flights: Dict[Hashable, asyncio.Future]
+
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key: Hashable,
+                 func: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._flights.get(key)
+        if fut is not None:
+            self.merged += 1
+        else:
+            self.calls += 1
+            fut = asyncio.ensure_future(func())
+            self._flights[key] = fut
+            fut.add_done_callback(
+                lambda _: self._flights.pop(key, None))
+        # one caller cancelled does not cancel the call of others
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'calls': self.calls,
+            'merged': self.merged,
+            'inflight': len(self._flights),
+        }
@@ -0,0 +1,378 @@
+from typing import Union, Optional, Any, List, Dict, Iterator, TYPE_CHECKING
+from collections import OrderedDict
+from bisect import bisect_left, insort
+import abc
+import logging
+import asyncio
+
+from grpclib.exceptions import GRPCError, StreamTerminatedError
+
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.mvccpb import kv_pb2
+
+from .utils import ensure_bytes, prefix_range_end
+from .watch import WatchCompacted, is_progress
+
+if TYPE_CHECKING:
+    from .client import Client
+
+logger = logging.getLogger(__name__)
+
+class WatchedPrefix(abc.ABC):
+    '''
+    The base of local copies of the keys with a prefix, the prefix is
+    loaded by range reads and kept current by watching from the
+    revision of the load, the prefix is loaded again when the revision
+    to watch from is compacted.
+    '''
+    client: 'Client'
+    prefix: bytes
+    range_end: bytes
+    page_size: int
+    progress_timeout: Optional[float]
+    revision: int = 0
+    _load_limit: int = 0
+    _synced: bool = False
+    _closed: bool = False
+    _task: Optional[asyncio.Future] = None
+
+    def __init__(self, client: 'Client',
+                 prefix: Union[bytes, str],
+                 page_size: int=1000,
+                 progress_timeout: Optional[float]=10.0):
+        '''
+        :param progress_timeout: the watch is treated as broken when
+        no progress is received in twice the timeout
+        '''
+        self.client = client
+        self.prefix = ensure_bytes(prefix)
+        self.range_end = prefix_range_end(self.prefix)
+        self.page_size = page_size
+        self.progress_timeout = progress_timeout
+
+    async def start(self) -> None:
+        '''
+        Load the prefix and start watching it
+        '''
+        await self._load()
+        self._task = asyncio.ensure_future(self._keep_watching())
+
+    def close(self) -> None:
+        self._closed = True
+        self._synced = False
+        if self._task is not None:
+            self._task.cancel()
+
+    @property
+    def synced(self) -> bool:
+        '''
+        Whether the copy is kept current by the watch
+        '''
+        return self._synced
+
+    def _contains(self, key: bytes) -> bool:
+        return self.prefix <= key < self.range_end
+
+    @abc.abstractmethod
+    def _reset(self, kvs: List[kv_pb2.KeyValue], revision: int) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _apply_event(self, event: kv_pb2.Event) -> None:
+        pass
+
+    def _apply(self, resp: pb2.WatchResponse) -> None:
+        # header.revision is only used by progress notifications, a
+        # catching up watcher may not have sent all the events before it
+        if is_progress(resp):
+            self.revision = max(self.revision, resp.header.revision)
+        for event in resp.events:
+            self._apply_event(event)
+            self.revision = max(self.revision, event.kv.mod_revision)
+
+    async def _load(self) -> None:
+        kvs: List[kv_pb2.KeyValue] = []
+        revision = 0
+        async for resp in self.client.kv.iter_pages(
+                self.prefix, self.range_end, page_size=self.page_size):
+            if not revision:
+                revision = resp.header.revision
+            kvs.extend(resp.kvs)
+            if self._load_limit and len(kvs) > self._load_limit:
+                break
+        self._reset(kvs, revision)
+        self.revision = revision
+        logger.info('loaded %s keys with prefix %s at revision %s',
+                    len(kvs), self.prefix, revision)
+
+    async def _keep_watching(self) -> None:
+        while not self._closed and self.client.is_alive():
+            try:
+                # synced once the events up to the revision the watch
+                # is created at are applied
+                synced_revision = 0
+                async for resp in self.client.watch.open_stream(
+                        (self.prefix, self.range_end),
+                        start_revision=self.revision + 1,
+                        progress_notify=True,
+                        progress_timeout=self.progress_timeout,
+                        with_created=True):
+                    if resp.created:
+                        synced_revision = resp.header.revision
+                    self._apply(resp)
+                    if synced_revision and self.revision >= synced_revision:
+                        self._synced = True
+                # the watch is canceled by the server, watch again from
+                # the revision after the last applied one
+                self._synced = False
+                logger.warning('stream watching %s ended', self.prefix)
+                self.client.select_server()
+                await asyncio.sleep(1)
+                continue
+            except (OSError, StreamTerminatedError, GRPCError) as e:
+                # not synced while waiting to retry
+                self._synced = False
+                logger.warning('watching %s failed, %s', self.prefix, e)
+                self.client.select_server()
+                await asyncio.sleep(1)
+                continue
+            except WatchCompacted as e:
+                # the events since then are lost, load the prefix again
+                logger.warning('watching %s compacted at %s',
+                               self.prefix, e.compact_revision)
+            except Exception:
+                self._synced = False
+                logger.exception('watching %s failed', self.prefix)
+                await asyncio.sleep(1)
+                continue
+            finally:
+                self._synced = False
+
+            try:
+                await self._load()
+            except Exception as e:
+                logger.warning('loading %s failed, %s', self.prefix, e)
+                await asyncio.sleep(1)
+
+class CachedKV(WatchedPrefix):
+    '''
+    A read through cache of the keys with a prefix, get() and
+    get_range() are served from memory and fall back to the cluster
+    on a miss or when the watch is broken.
+
+    At most max_keys keys are cached, the least recently used ones
+    are evicted, once a key is evicted a missing key can no longer be
+    told absent without asking the cluster.
+    '''
+    max_keys: int
+    hits: int = 0
+    misses: int = 0
+    _kvs: 'OrderedDict[bytes, kv_pb2.KeyValue]'
+    _complete: bool = False
+
+    def __init__(self, client: 'Client',
+                 prefix: Union[bytes, str],
+                 max_keys: int=10000,
+                 page_size: int=1000,
+                 progress_timeout: Optional[float]=10.0):
+        super().__init__(client, prefix,
+                         page_size=page_size,
+                         progress_timeout=progress_timeout)
+        self.max_keys = max_keys
+        self._load_limit = max_keys
+        self._kvs = OrderedDict()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'keys': len(self._kvs),
+            'revision': self.revision,
+            'hits': self.hits,
+            'misses': self.misses,
+            'complete': self._complete,
+            'synced': self._synced,
+        }
+
+    async def get(self, key: Union[bytes, str]) -> Optional[bytes]:
+        key = ensure_bytes(key)
+        if self._synced and self._contains(key):
+            kv = self._kvs.get(key)
+            if kv is not None:
+                self._kvs.move_to_end(key)
+                self.hits += 1
+                return kv.value
+            elif self._complete:
+                self.hits += 1
+                return None
+
+        self.misses += 1
+        resp = await self.client.kv.get_range(key, b'')
+        if resp.kvs:
+            # a read older than the cache may miss a delete applied
+            # while waiting, a newer one is corrected by the events
+            # applied later
+            if (self._synced and self._contains(key)
+                and resp.header.revision >= self.revision):
+                self._store(resp.kvs[0])
+            return resp.kvs[0].value
+        else:
+            return None
+
+    async def get_range(self,
+                        start: Union[bytes, str],
+                        end: Union[bytes, str]) -> pb2.RangeResponse:
+        '''
+        Read [start, end) from memory if the range is in the prefix
+        and fully cached, the header.revision of the response is the
+        revision the cache is current to.
+        '''
+        start = ensure_bytes(start)
+        end = ensure_bytes(end)
+        if (self._synced and self._complete
+            and self._contains(start)
+            and (not end or self.prefix < end <= self.range_end)):
+            self.hits += 1
+            if not end:
+                kvs = [self._kvs[start]] if start in self._kvs else []
+            else:
+                kvs = sorted((kv for key, kv in self._kvs.items()
+                              if start <= key < end),
+                             key=lambda kv: kv.key)
+            return pb2.RangeResponse(
+                header=pb2.ResponseHeader(revision=self.revision),
+                kvs=kvs,
+                count=len(kvs))
+
+        self.misses += 1
+        return await self.client.kv.get_range(start, end)
+
+    def _store(self, kv: kv_pb2.KeyValue) -> None:
+        cached = self._kvs.get(kv.key)
+        if cached is not None and cached.mod_revision > kv.mod_revision:
+            # a newer version is cached already
+            return
+        self._kvs[kv.key] = kv
+        self._kvs.move_to_end(kv.key)
+        while len(self._kvs) > self.max_keys:
+            self._kvs.popitem(last=False)
+            self._complete = False
+
+    def _reset(self, kvs: List[kv_pb2.KeyValue], revision: int) -> None:
+        self._complete = len(kvs) <= self.max_keys
+        self._kvs = OrderedDict(
+            (kv.key, kv) for kv in kvs[:self.max_keys])
+
+    def _apply_event(self, event: kv_pb2.Event) -> None:
+        kv = event.kv
+        if event.type == kv_pb2.Event.EventType.DELETE:
+            cached = self._kvs.get(kv.key)
+            if (cached is not None
+                and cached.mod_revision < kv.mod_revision):
+                del self._kvs[kv.key]
+        elif kv.key in self._kvs or self._complete:
+            self._store(kv)
+
+class MirrorSnapshot:
+    '''
+    A read only view of a PrefixMirror at a revision, it is not
+    changed by the events applied to the mirror later.
+    '''
+    revision: int
+    _keys: List[bytes]
+    _kvs: Dict[bytes, kv_pb2.KeyValue]
+
+    def __init__(self, keys: List[bytes],
+                 kvs: Dict[bytes, kv_pb2.KeyValue],
+                 revision: int):
+        self._keys = keys
+        self._kvs = kvs
+        self.revision = revision
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[kv_pb2.KeyValue]:
+        for key in self._keys:
+            yield self._kvs[key]
+
+    def get(self, key: Union[bytes, str]) -> Optional[kv_pb2.KeyValue]:
+        return self._kvs.get(ensure_bytes(key))
+
+    def range(self,
+              start: Union[bytes, str],
+              end: Union[bytes, str]) -> List[kv_pb2.KeyValue]:
+        '''
+        The key values in [start, end) in key order, end b'' means the
+        start key only and b'\\0' means all keys from start.
+        '''
+        start = ensure_bytes(start)
+        end = ensure_bytes(end)
+        if not end:
+            kv = self._kvs.get(start)
+            return [kv] if kv is not None else []
+        lo = bisect_left(self._keys, start)
+        if end == b'\0':
+            hi = len(self._keys)
+        else:
+            hi = bisect_left(self._keys, end, lo)
+        return [self._kvs[key] for key in self._keys[lo:hi]]
+
+class PrefixMirror(WatchedPrefix):
+    '''
+    A full copy of the keys with a prefix kept in key order, so range
+    queries cost O(log n + k) locally.
+
+    snapshot() shares the sorted keys with the mirror until the next
+    event is applied, which copies them first, so iterating a snapshot
+    never blocks nor sees the events being applied.
+    '''
+    _keys: List[bytes]
+    _kvs: Dict[bytes, kv_pb2.KeyValue]
+    _shared: bool = False
+
+    def __init__(self, client: 'Client',
+                 prefix: Union[bytes, str],
+                 page_size: int=1000,
+                 progress_timeout: Optional[float]=10.0):
+        super().__init__(client, prefix,
+                         page_size=page_size,
+                         progress_timeout=progress_timeout)
+        self._keys = []
+        self._kvs = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def snapshot(self) -> MirrorSnapshot:
+        self._shared = True
+        return MirrorSnapshot(self._keys, self._kvs, self.revision)
+
+    def get(self, key: Union[bytes, str]) -> Optional[kv_pb2.KeyValue]:
+        return self._kvs.get(ensure_bytes(key))
+
+    def range(self,
+              start: Union[bytes, str],
+              end: Union[bytes, str]) -> List[kv_pb2.KeyValue]:
+        return MirrorSnapshot(self._keys, self._kvs, self.revision).range(
+            start, end)
+
+    def _reset(self, kvs: List[kv_pb2.KeyValue], revision: int) -> None:
+        # kvs are loaded in key order
+        self._keys = [kv.key for kv in kvs]
+        self._kvs = {kv.key: kv for kv in kvs}
+        self._shared = False
+
+    def _apply_event(self, event: kv_pb2.Event) -> None:
+        if self._shared:
+            # copy on write, the snapshots keep the old ones
+            self._keys = list(self._keys)
+            self._kvs = dict(self._kvs)
+            self._shared = False
+        kv = event.kv
+        if event.type == kv_pb2.Event.EventType.DELETE:
+            if self._kvs.pop(kv.key, None) is not None:
+                i = bisect_left(self._keys, kv.key)
+                del self._keys[i]
+        else:
+            if kv.key not in self._kvs:
+                insort(self._keys, kv.key)
+            self._kvs[kv.key] = kv
@@ -1,14 +1,14 @@
-from typing import Union, Optional, Any, List, Tuple, Dict, Type, AsyncGenerator
+from typing import (Union, Optional, Any, List, Tuple, Dict, Type,
+                    Sequence, AsyncGenerator)
+import time
 import logging
-from urllib.parse import urlparse
 import asyncio
 from asyncio import Queue
 
-from random import choice
 from functools import wraps
 
 from grpclib.client import Channel, Stream
-from grpclib.exceptions import StreamTerminatedError
+from grpclib.exceptions import GRPCError, StreamTerminatedError
 
 from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
 from aioetcdm3.pb.mvccpb import kv_pb2
@@ -16,49 +16,202 @@ from aioetcdm3.pb.etcdserverpb.rpc_grpc import (
     KVStub, WatchStub, LeaseStub, ClusterStub,
     MaintenanceStub, AuthStub)
 
-from .utils import ensure_bytes, prefix_range_end
+from .utils import ensure_bytes, prefix_range_end, split_range
+from .endpoint import Endpoint, Balancer
+from .batch import SingleFlight
+from .lease import LeaseKeeper, LeaseKeys
+from .watch import (WatchMultiplexer, WatchCompacted, FragmentAssembler,
+                    ProgressWatchdog, is_progress, watch_create_args)
 
 logger = logging.getLogger(__name__)
 
 KeyRange = Union[str, bytes, Tuple[Union[bytes, str], Union[bytes, str]]]
 
+CONSISTENCIES = ('linearizable', 'serializable')
+
 class Client:
-    channel: Channel
+    endpoint: Optional[Endpoint] = None
     status: str = 'alive'
     _kv: Optional['KVSection'] = None
     _lease: Optional['LeaseSection'] = None
     _watch: Optional['WatchSection'] = None
     _cluster: Optional['ClusterSection'] = None
+    _maintenance: Optional['MaintenanceSection'] = None
     _server_urls: List[str]
     _current_server_url: str = ''
+    _endpoints: Dict[str, Endpoint]
+    balancer: Balancer
+    _leader_task: Optional[asyncio.Future] = None
+    consistency: str
+    single_flight: bool
+    _pool_size: int
     _etcd_args: Dict[str, Any]
 
-    def __init__(self, server_url, **kwargs):
+    def __init__(self, server_url,
+                 pool_size: int=1,
+                 consistency: str='linearizable',
+                 single_flight: bool=False,
+                 **kwargs):
+        '''
+        :param pool_size: the number of channels, aka HTTP/2
+        connections, opened to each etcd server
+        :param consistency: the default consistency of reads,
+        'linearizable' or 'serializable'
+        :param single_flight: identical serializable or fixed revision
+        range requests issued concurrently share one rpc and one
+        response object, which must not be modified by callers
+        '''
+        assert consistency in CONSISTENCIES, \
+            f'consistency must be one of {CONSISTENCIES}'
         self._server_urls = [server_url]
+        self.consistency = consistency
+        self.single_flight = single_flight
+        self._endpoints = {}
+        self.balancer = Balancer()
+        self.balancer.on_term_change = self._on_term_change
+        self._pool_size = pool_size
         self._etcd_args = kwargs
         self.select_server()
 
     def select_server(self):
+        '''
+        Switch to the fastest healthy server, called when the current
+        server failed.
+        '''
         assert self._server_urls
-        self._current_server_url = choice(self._server_urls)
+        self._current_server_url = self.balancer.choose(self._server_urls)
         logger.info('selected etcd server %s', self._current_server_url)
-        parsed = urlparse(self._current_server_url)
-        if ':' in parsed.netloc:
-            host, port = parsed.netloc.split(':')
-            port = int(port)
+        prev_endpoint = self.endpoint
+        self.endpoint = self.get_endpoint(self._current_server_url)
+        if (prev_endpoint is not None
+            and prev_endpoint is not self.endpoint):
+            # the old channel is closed after its requests are drained
+            self.retire_endpoint(prev_endpoint.url)
+
+    def rebalance(self) -> None:
+        '''
+        Route requests to the fastest healthy server, the endpoint
+        switched from is kept open for later use.
+        '''
+        assert self._server_urls
+        server_url = self.balancer.choose(self._server_urls)
+        if server_url != self._current_server_url:
+            logger.info('switch etcd server from %s to %s',
+                        self._current_server_url, server_url)
+            self._current_server_url = server_url
+            self.endpoint = self.get_endpoint(server_url)
+
+    def get_endpoint(self, server_url: str) -> Endpoint:
+        endpoint = self._endpoints.get(server_url)
+        if endpoint is None:
+            endpoint = Endpoint(server_url,
+                                pool_size=self._pool_size,
+                                balancer=self.balancer,
+                                **self._etcd_args)
+            self._endpoints[server_url] = endpoint
+        return endpoint
+
+    def retire_endpoint(self, server_url: str) -> None:
+        endpoint = self._endpoints.pop(server_url, None)
+        if endpoint is not None:
+            endpoint.retire()
+
+    def scoreboard(self) -> List[Dict[str, Any]]:
+        '''
+        :return: the latency and health of each server, the fastest
+        healthy server comes first
+        '''
+        board = self.balancer.scoreboard()
+        for stats in board:
+            stats['current'] = stats['url'] == self._current_server_url
+        return board
+
+    def get_stub(self, stub_cls: Type, route: str='current') -> Any:
+        '''
+        :param route: where the stub is connected to,
+          'current': the current server
+          'leader': the leader, fall back to the current server if the
+                    leader is unknown
+          'nearest': the fastest healthy server including learners,
+                     only for serializable reads
+        '''
+        if route == 'leader':
+            leader_url = self.balancer.leader_url()
+            if leader_url is not None:
+                return self.get_endpoint(leader_url).stub(stub_cls)
+        elif route == 'nearest':
+            server_url = self.balancer.choose(self._server_urls,
+                                              allow_learner=True)
+            return self.get_endpoint(server_url).stub(stub_cls)
         else:
-            host = parsed.netloc
-            port = 2379
-        # TODO: handle ssl
-        self.channel = Channel(host, port, **self._etcd_args)
+            assert route == 'current', f'invalid route {route}'
+        assert self.endpoint is not None
+        return self.endpoint.stub(stub_cls)
+
+    async def discover_leader(self) -> Optional[str]:
+        '''
+        Find the leader from the status of the current server.
+
+        :return: the url of the leader
+        '''
+        resp = await self.maintenance.status()
+        balancer = self.balancer
+        leader_urls = [stats.url for stats in balancer.stats.values()
+                       if stats.member_id == resp.leader]
+        if not leader_urls:
+            # the leader is not known by url yet
+            for member in await self.cluster.list_members():
+                for server_url in member.clientURLs:
+                    balancer.get_stats(server_url).member_id = member.ID
+                    if member.ID == resp.leader:
+                        leader_urls.append(server_url)
+        balancer.set_leader(resp.leader, resp.raftTerm)
+        if balancer.leader_id == resp.leader:
+            # the leader is followed by the quorum, route to it again
+            # even if it failed before
+            for server_url in leader_urls:
+                balancer.mark_healthy(server_url)
+        leader_url = balancer.leader_url()
+        logger.info('leader of raft term %s is %s',
+                    self.balancer.raft_term, leader_url)
+        return leader_url
+
+    def _on_term_change(self, raft_term: int) -> None:
+        if self._leader_task is None or self._leader_task.done():
+            self._leader_task = asyncio.ensure_future(
+                self._rediscover_leader())
+
+    async def _rediscover_leader(self) -> None:
+        raft_term = 0
+        # a newer term seen while discovering resets the leader found,
+        # discover again until the term is stable
+        while self.is_alive() and raft_term != self.balancer.raft_term:
+            raft_term = self.balancer.raft_term
+            try:
+                await self.discover_leader()
+            except (OSError, asyncio.TimeoutError, GRPCError) as e:
+                logger.warning('discover leader failed, %s', e)
+                return
+
+    @property
+    def channel(self) -> Channel:
+        assert self.endpoint is not None
+        return self.endpoint.channel
 
     def is_alive(self) -> bool:
         return self.status == 'alive'
 
     def close(self) -> None:
         self.status = 'closed'
-        self.channel.close()
-        print('cccc')
+        if self._leader_task is not None:
+            self._leader_task.cancel()
+        if self._watch is not None and self._watch._multiplexer is not None:
+            self._watch._multiplexer.close()
+        if self._lease is not None and self._lease._keeper is not None:
+            self._lease._keeper.close()
+        for endpoint in self._endpoints.values():
+            endpoint.close()
+        self._endpoints = {}
 
     async def collect_members(self, sleep_interval: float=60.0):
         '''\
@@ -72,12 +225,32 @@ class Client:
                     server_urls.extend(member.clientURLs)
                     self._server_urls = server_urls
                     logger.info('current members %s', self._server_urls)
+                for server_url in list(self._endpoints):
+                    if (server_url not in self._server_urls
+                        and server_url != self._current_server_url):
+                        self.retire_endpoint(server_url)
                 await asyncio.sleep(sleep_interval)
             except RuntimeError as e:
                 print('runtime error', e)
                 logging.warning('runtime error %s', e)
                 break
 
+    async def probe_servers(self,
+                            sleep_interval: float=10.0,
+                            timeout: float=3.0):
+        '''
+        Periodly probe the status of every server to measure its
+        latency and health, requests are routed to the fastest
+        healthy server.
+        '''
+        while self.is_alive():
+            await asyncio.gather(*[
+                self.maintenance.probe(server_url, timeout=timeout)
+                for server_url in self._server_urls])
+            if self.is_alive():
+                self.rebalance()
+            await asyncio.sleep(sleep_interval)
+
     @property
     def kv(self) -> 'KVSection':
         if self._kv is None:
@@ -102,6 +275,12 @@ class Client:
             self._cluster = ClusterSection(self)
         return self._cluster
 
+    @property
+    def maintenance(self) -> 'MaintenanceSection':
+        if self._maintenance is None:
+            self._maintenance = MaintenanceSection(self)
+        return self._maintenance
+
 
 class ClientSection:
     client: 'Client'
@@ -112,7 +291,23 @@ class ClientSection:
 
     @property
     def stub(self) -> Any:
-        return self.stub_cls(self.client.channel)
+        return self.client.get_stub(self.stub_cls)
+
+    @property
+    def leader_stub(self) -> Any:
+        '''
+        The stub to send writes, which is connected to the leader
+        directly to save the hop of forwarding
+        '''
+        return self.client.get_stub(self.stub_cls, route='leader')
+
+    @property
+    def nearest_stub(self) -> Any:
+        '''
+        The stub connected to the fastest server, learners included,
+        which is used by serializable reads
+        '''
+        return self.client.get_stub(self.stub_cls, route='nearest')
 
 def section_retry(n:int=10):
     def outer(func):
@@ -132,8 +327,20 @@ def section_retry(n:int=10):
         return wrapped
     return outer
 
+def _prefix_range(prefix: Union[bytes, str]) -> Tuple[bytes, bytes]:
+    prefix = ensure_bytes(prefix)
+    if not prefix:
+        # all keys
+        return b'\0', b'\0'
+    return prefix, prefix_range_end(prefix)
+
 class KVSection(ClientSection):
     stub_cls = KVStub
+    range_flight: SingleFlight
+
+    def __init__(self, client: 'Client'):
+        super().__init__(client)
+        self.range_flight = SingleFlight()
 
     @section_retry()
     async def put(self,
@@ -154,7 +361,7 @@ class KVSection(ClientSection):
             lease=lease_id
         )
         if expect_prev_value is None:
-            resp = await self.stub.Put(req)
+            resp = await self.leader_stub.Put(req)
             return True
         else:
             expect_prev_value = ensure_bytes(expect_prev_value)
@@ -167,14 +374,38 @@ class KVSection(ClientSection):
                 )],
                 success=[pb2.RequestOp(request_put=req)]
             )
-            txnresp = await self.stub.Txn(txnreq)
+            txnresp = await self.leader_stub.Txn(txnreq)
             return txnresp.succeeded
 
+    @section_retry()
+    async def txn(self,
+                  compare: Optional[List[pb2.Compare]]=None,
+                  success: Optional[List[pb2.RequestOp]]=None,
+                  failure: Optional[List[pb2.RequestOp]]=None
+                  ) -> pb2.TxnResponse:
+        '''
+        Apply the success ops if all compares are true else the
+        failure ops, in one request
+        '''
+        return await self.leader_stub.Txn(
+            pb2.TxnRequest(
+                compare=compare or [],
+                success=success or [],
+                failure=failure or []))
+
     async def get(self,
-                  key: Union[bytes, str]) -> Optional[bytes]:
+                  key: Union[bytes, str],
+                  consistency: Optional[str]=None,
+                  revision: int=0) -> Optional[bytes]:
+        '''
+        :param revision: read the value at the given revision, 0 means
+        the latest
+        '''
         key = ensure_bytes(key)
 
-        resp = await self.get_range(key, b"")
+        resp = await self.get_range(key, b"",
+                                    consistency=consistency,
+                                    revision=revision)
         if resp.kvs:
             return resp.kvs[0].value
         else:
@@ -185,7 +416,29 @@ class KVSection(ClientSection):
                         start: Union[bytes, str],
                         end: Union[bytes, str],
                         limit: int=0,
-                        sort_by: str='') -> pb2.RangeResponse:
+                        sort_by: str='',
+                        consistency: Optional[str]=None,
+                        revision: int=0,
+                        keys_only: bool=False,
+                        count_only: bool=False,
+                        min_mod_revision: int=0,
+                        max_mod_revision: int=0,
+                        min_create_revision: int=0,
+                        max_create_revision: int=0
+    ) -> pb2.RangeResponse:
+        '''
+        :param revision: read at the given revision, 0 means the latest
+        :param keys_only: return only the keys without values
+        :param count_only: return only the count of keys
+        :param min_mod_revision, max_mod_revision: filter out keys
+        modified before or after the revisions, 0 means no filter
+        :param min_create_revision, max_create_revision: filter out
+        keys created before or after the revisions, 0 means no filter
+        :param consistency: 'linearizable' or 'serializable', the
+        default consistency of client is used if not given.
+        serializable reads are served locally by the nearest member
+        and may be stale.
+        '''
         start = ensure_bytes(start)
 
         end = ensure_bytes(end)
@@ -205,15 +458,212 @@ class KVSection(ClientSection):
         sort_target = getattr(pb2.RangeRequest.SortTarget,
                               sort_t.upper())
 
-        resp = await self.stub.Range(
-            pb2.RangeRequest(
-                key=start,
-                range_end=end,
-                limit=limit,
-                sort_order=sort_order,
-                sort_target=sort_target
-            ))
-        return resp
+        if consistency is None:
+            consistency = self.client.consistency
+        assert consistency in CONSISTENCIES, \
+            f'consistency must be one of {CONSISTENCIES}'
+        serializable = consistency == 'serializable'
+
+        stub = self.nearest_stub if serializable else self.stub
+        req = pb2.RangeRequest(
+            key=start,
+            range_end=end,
+            limit=limit,
+            sort_order=sort_order,
+            sort_target=sort_target,
+            serializable=serializable,
+            revision=revision,
+            keys_only=keys_only,
+            count_only=count_only,
+            min_mod_revision=min_mod_revision,
+            max_mod_revision=max_mod_revision,
+            min_create_revision=min_create_revision,
+            max_create_revision=max_create_revision
+        )
+        # a linearizable read of the latest revision must not join a
+        # read started before a write it follows
+        if not self.client.single_flight or not (serializable or revision):
+            return await stub.Range(req)
+        # the serialized request covers the key, range and all flags
+        return await self.range_flight.do(
+            req.SerializeToString(deterministic=True),
+            lambda: stub.Range(req))
+
+    async def iter_range(self,
+                         start: Union[bytes, str],
+                         end: Union[bytes, str],
+                         page_size: int=1000,
+                         consistency: Optional[str]=None,
+                         revision: int=0,
+                         keys_only: bool=False,
+                         min_mod_revision: int=0
+    ) -> AsyncGenerator[kv_pb2.KeyValue, None]:
+        '''
+        Iterate the key values in [start, end) in key order, one page
+        of page_size keys is read at a time. All pages are read at the
+        revision of the first page, so they are a consistent snapshot.
+        '''
+        async for resp in self.iter_pages(start, end,
+                                          page_size=page_size,
+                                          consistency=consistency,
+                                          revision=revision,
+                                          keys_only=keys_only,
+                                          min_mod_revision=min_mod_revision):
+            for kv in resp.kvs:
+                yield kv
+
+    async def iter_pages(self,
+                         start: Union[bytes, str],
+                         end: Union[bytes, str],
+                         page_size: int=1000,
+                         consistency: Optional[str]=None,
+                         revision: int=0,
+                         keys_only: bool=False,
+                         min_mod_revision: int=0
+    ) -> AsyncGenerator[pb2.RangeResponse, None]:
+        '''
+        Iterate the range responses of [start, end) page by page, the
+        pages are read at the given revision or the revision of the
+        first page.
+        '''
+        assert page_size > 0, 'page size must be positive'
+        start = ensure_bytes(start)
+        end = ensure_bytes(end)
+        while True:
+            resp = await self.get_range(start, end,
+                                        limit=page_size,
+                                        consistency=consistency,
+                                        revision=revision,
+                                        keys_only=keys_only,
+                                        min_mod_revision=min_mod_revision)
+            if not revision:
+                revision = resp.header.revision
+            yield resp
+            if not resp.more or not resp.kvs:
+                break
+            # continue from the key right after the last one
+            start = resp.kvs[-1].key + b'\0'
+
+    async def scan(self,
+                   start: Union[bytes, str],
+                   end: Union[bytes, str],
+                   shards: int=4,
+                   page_size: int=1000,
+                   boundaries: Optional[List[Union[bytes, str]]]=None,
+                   consistency: Optional[str]=None,
+                   prefetch: int=2
+    ) -> AsyncGenerator[kv_pb2.KeyValue, None]:
+        '''
+        Scan the key values in [start, end) in key order, the range is
+        split into sub ranges which are fetched concurrently at the
+        same revision.
+
+        :param shards: the number of sub ranges split at byte
+        boundaries, see utils.split_range
+        :param boundaries: the keys to split the range at, which is
+        used instead of shards when the key distribution is known
+        :param prefetch: pages buffered for each sub range
+        '''
+        start = ensure_bytes(start)
+        end = ensure_bytes(end)
+        if boundaries is None:
+            ranges = split_range(start, end, shards)
+        else:
+            keys = [start] + sorted(
+                ensure_bytes(k) for k in boundaries
+                if start < ensure_bytes(k) and (
+                    end == b'\0' or ensure_bytes(k) < end)) + [end]
+            ranges = list(zip(keys[:-1], keys[1:]))
+
+        # all sub ranges are read at the same revision
+        resp = await self.get_range(start, end,
+                                    consistency=consistency,
+                                    count_only=True)
+        revision = resp.header.revision
+
+        queues: List[Queue] = [Queue(maxsize=prefetch) for _ in ranges]
+
+        async def fetch(queue: Queue, sub_start: bytes, sub_end: bytes):
+            try:
+                async for page in self.iter_pages(sub_start, sub_end,
+                                                  page_size=page_size,
+                                                  consistency=consistency,
+                                                  revision=revision):
+                    await queue.put(page)
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        tasks = [asyncio.ensure_future(fetch(queue, sub_start, sub_end))
+                 for queue, (sub_start, sub_end) in zip(queues, ranges)]
+        try:
+            for queue in queues:
+                while True:
+                    page = await queue.get()
+                    if page is None:
+                        break
+                    elif isinstance(page, Exception):
+                        raise page
+                    for kv in page.kvs:
+                        yield kv
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def count(self,
+                    prefix: Union[bytes, str],
+                    consistency: Optional[str]=None) -> int:
+        '''
+        :return: the number of keys with the prefix, no key value is
+        transferred
+        '''
+        start, end = _prefix_range(prefix)
+        resp = await self.get_range(start, end,
+                                    consistency=consistency,
+                                    count_only=True)
+        return resp.count
+
+    async def keys(self,
+                   prefix: Union[bytes, str],
+                   page_size: int=1000,
+                   consistency: Optional[str]=None
+    ) -> AsyncGenerator[bytes, None]:
+        '''
+        Iterate the keys with the prefix page by page, values are not
+        transferred.
+        '''
+        start, end = _prefix_range(prefix)
+        async for kv in self.iter_range(start, end,
+                                        page_size=page_size,
+                                        consistency=consistency,
+                                        keys_only=True):
+            yield kv.key
+
+    async def changes_since(self,
+                            prefix: Union[bytes, str],
+                            revision: int,
+                            page_size: int=1000,
+                            consistency: Optional[str]=None
+    ) -> Tuple[List[kv_pb2.KeyValue], int]:
+        '''
+        Read the keys with the prefix which are created or modified
+        after the given revision, deleted keys are not returned, watch
+        from the revision to get them.
+
+        :return: the changed key values and the revision they are read
+        at, which is the revision to pass in the next time
+        '''
+        start, end = _prefix_range(prefix)
+        kvs: List[kv_pb2.KeyValue] = []
+        read_revision = 0
+        async for resp in self.iter_pages(start, end,
+                                          page_size=page_size,
+                                          consistency=consistency,
+                                          min_mod_revision=revision + 1):
+            if not read_revision:
+                read_revision = resp.header.revision
+            kvs.extend(resp.kvs)
+        return kvs, read_revision
 
     async def delete(self,
                      key: Union[bytes, str],
@@ -234,7 +684,7 @@ class KVSection(ClientSection):
         start = ensure_bytes(start)
         end = ensure_bytes(end)
 
-        resp = await self.stub.DeleteRange(
+        resp = await self.leader_stub.DeleteRange(
             pb2.DeleteRangeRequest(
                 key=start,
                 range_end=end,
@@ -243,6 +693,7 @@ class KVSection(ClientSection):
 
 class LeaseSection(ClientSection):
     stub_cls = LeaseStub
+    _keeper: Optional[LeaseKeeper] = None
 
     @section_retry()
     async def grant(self, ttl: int, lease_id: int=0) -> pb2.LeaseGrantResponse:
@@ -258,47 +709,239 @@ class LeaseSection(ClientSection):
             pb2.LeaseRevokeRequest(
                 ID=lease_id))
 
-    @section_retry()
+    @property
+    def keeper(self) -> LeaseKeeper:
+        '''
+        The keeper shared by the client, which keeps all leases alive
+        over one stream
+        '''
+        if self._keeper is None:
+            self._keeper = LeaseKeeper(self.client)
+        return self._keeper
+
+    async def grant_keys(self,
+                         kvs: Dict[Union[bytes, str], Union[bytes, str]],
+                         ttl: int) -> LeaseKeys:
+        '''
+        Grant a lease and attach the keys to it in one txn, the lease
+        is kept alive and the keys are written again if it expires
+        '''
+        lease_keys = LeaseKeys(self.client, kvs, ttl)
+        await lease_keys.start()
+        return lease_keys
+
     async def keep_alive(self, *lease_ids:int, sleep_interval:float=1) -> None:
+        '''
+        Keep the leases alive by the shared keeper until the client is
+        closed or the call is cancelled
+
+        :param sleep_interval: seconds between checks of the client
+        '''
         assert not not lease_ids, "lease id list cannot be empty"
-        async with self.stub.LeaseKeepAlive.open() as stream:
+        keeper = self.keeper
+        for lease_id in lease_ids:
+            keeper.register(lease_id)
+        try:
             while self.client.is_alive():
-                for lease_id in lease_ids:
-                    await stream.send_message(
-                        pb2.LeaseKeepAliveRequest(
-                            ID=lease_id))
-                for _ in lease_ids:
-                    resp = await stream.recv_message()
-
                 await asyncio.sleep(sleep_interval)
+        finally:
+            for lease_id in lease_ids:
+                keeper.unregister(lease_id)
 
-    # TODO: TimeToLive and Lease and Leases
+    @section_retry()
+    async def time_to_live(self, lease_id: int,
+                           keys: bool=True) -> pb2.LeaseTimeToLiveResponse:
+        '''
+        :param keys: list the keys attached to the lease
+        :return: the response whose TTL is -1 if the lease is expired
+        or not found
+        '''
+        return await self.leader_stub.LeaseTimeToLive(
+            pb2.LeaseTimeToLiveRequest(
+                ID=lease_id,
+                keys=keys))
+
+    @section_retry()
+    async def leases(self) -> pb2.LeaseLeasesResponse:
+        '''
+        :return: the response listing the ids of all leases
+        '''
+        return await self.leader_stub.LeaseLeases(
+            pb2.LeaseLeasesRequest())
+
+    async def inspect(self,
+                      lease_ids: Optional[Sequence[int]]=None,
+                      keys: bool=False,
+                      concurrency: int=32
+    ) -> AsyncGenerator[pb2.LeaseTimeToLiveResponse, None]:
+        '''
+        Call time_to_live() for many leases concurrently, the responses
+        are yielded as they come, not in the order of lease_ids.
+
+        :param lease_ids: the leases to inspect, all leases by default
+        :param keys: list the keys attached to each lease
+        :param concurrency: the max calls in flight
+        '''
+        assert concurrency >= 1
+        if lease_ids is None:
+            lease_ids = [lease.ID for lease in (await self.leases()).leases]
+        pending = iter(lease_ids)
+        results: Queue = Queue(maxsize=concurrency)
+
+        async def work():
+            try:
+                for lease_id in pending:
+                    await results.put(
+                        await self.time_to_live(lease_id, keys=keys))
+                await results.put(None)
+            except Exception as e:
+                await results.put(e)
+
+        workers = [asyncio.ensure_future(work())
+                   for _ in range(min(concurrency, len(lease_ids)))]
+        try:
+            running = len(workers)
+            while running:
+                resp = await results.get()
+                if resp is None:
+                    running -= 1
+                elif isinstance(resp, Exception):
+                    raise resp
+                else:
+                    yield resp
+        finally:
+            for worker in workers:
+                worker.cancel()
 
 class WatchSection(ClientSection):
     stub_cls = WatchStub
+    _multiplexer: Optional[WatchMultiplexer] = None
+
+    def multiplexer(self) -> WatchMultiplexer:
+        '''
+        The multiplexer shared by the client, which creates all
+        watches over one stream
+        '''
+        if self._multiplexer is None:
+            self._multiplexer = WatchMultiplexer(self.client)
+        return self._multiplexer
 
     async def keep_watching(self,
-                            *key_ranges:KeyRange
+                            *key_ranges:KeyRange,
+                            start_revision: int=0,
+                            progress_notify: bool=False,
+                            progress_timeout: Optional[float]=None,
+                            no_put: bool=False,
+                            no_delete: bool=False,
+                            prev_kv: bool=False,
+                            fragment: bool=False
     ) -> AsyncGenerator[pb2.WatchResponse, None]:
+        '''
+        Watch the key ranges and reopen the stream when broken, the
+        watches are created again from the revision after the last
+        delivered one, so no event is lost. Progress notifications
+        advance the revision of quiet watches. See open_stream() for
+        the arguments.
+
+        :raise WatchCompacted: the revision to resume from is
+        compacted, the watched keys must be resynced
+        '''
+        create_args = watch_create_args(progress_notify=progress_notify,
+                                        no_put=no_put,
+                                        no_delete=no_delete,
+                                        prev_kv=prev_kv,
+                                        fragment=fragment)
+        # the next revision to watch of each key range, 0 means now
+        revisions = [start_revision] * len(key_ranges)
         while self.client.is_alive():
             try:
-                async for resp in self.open_stream(*key_ranges):
+                async for i, resp in self._open_stream(
+                        key_ranges, revisions, create_args,
+                        progress_timeout=progress_timeout):
+                    if resp.created:
+                        if not revisions[i]:
+                            revisions[i] = resp.header.revision + 1
+                        continue
+                    if resp.events:
+                        if i >= 0:
+                            revisions[i] = resp.events[-1].kv.mod_revision + 1
+                    elif is_progress(resp):
+                        # i < 0 for the response of a progress request
+                        for j in (range(len(revisions)) if i < 0 else [i]):
+                            revisions[j] = max(revisions[j],
+                                               resp.header.revision + 1)
                     yield resp
-            except OSError as e:
-                # ConnectionRefusedError
+                # the watches are canceled by the server
+                logger.warning('stream watching %s ended', key_ranges)
+            except (OSError, StreamTerminatedError, GRPCError) as e:
+                # ConnectionRefusedError, a dead stream, or an error
+                # status such as UNAVAILABLE when the server has no leader
                 logger.warning('watching failed, %s', e)
+            if self.client.is_alive():
                 self.client.select_server()
                 await asyncio.sleep(1)
 
     async def open_stream(self,
-                   *key_ranges:KeyRange
+                   *key_ranges:KeyRange,
+                   start_revision: int=0,
+                   progress_notify: bool=False,
+                   progress_timeout: Optional[float]=None,
+                   no_put: bool=False,
+                   no_delete: bool=False,
+                   prev_kv: bool=False,
+                   fragment: bool=False,
+                   with_created: bool=False
     ) -> AsyncGenerator[pb2.WatchResponse, None]:
+        '''
+        :param start_revision: watch the events from the revision
+        (inclusive), 0 means from now
+        :param progress_notify: the server sends empty responses
+        periodically to quiet watches, whose header.revision tells the
+        progress
+        :param progress_timeout: request progress when nothing is
+        received within the timeout, and end the stream as dead when
+        still nothing is received within another timeout
+        :param no_put, no_delete: filter out the put or delete events
+        at server side
+        :param prev_kv: the events carry the key value before them
+        :param fragment: the server splits the responses larger than
+        its request size limit, the fragments are merged back into one
+        response before yielded
+        :param with_created: yield the created responses too, whose
+        header.revision is the revision the watches are created at
+        :raise WatchCompacted: the start revision is compacted
+        :raise WatchFragmentOverflow: the fragments of a response
+        exceed MAX_FRAGMENT_BYTES
+        :raise StreamTerminatedError: the stream is ended by the server
+        or found dead by progress_timeout
+        '''
+        create_args = watch_create_args(progress_notify=progress_notify,
+                                        no_put=no_put,
+                                        no_delete=no_delete,
+                                        prev_kv=prev_kv,
+                                        fragment=fragment)
+        async for _, resp in self._open_stream(
+                key_ranges, [start_revision] * len(key_ranges),
+                create_args,
+                progress_timeout=progress_timeout):
+            if with_created or not resp.created:
+                yield resp
 
+    async def _open_stream(self,
+                           key_ranges: Sequence[KeyRange],
+                           start_revisions: List[int],
+                           create_args: Dict[str, Any],
+                           progress_timeout: Optional[float]=None
+    ) -> AsyncGenerator[Tuple[int, pb2.WatchResponse], None]:
+        '''
+        Yield the index of the key range along with each response, the
+        index is -1 for responses to all watches
+        '''
         async with self.stub.Watch.open() as stream:
             logging.info('stream %s opened to watch %s', stream, key_ranges)
 
             #for key, range_end in key_ranges:
-            for r in key_ranges:
+            for r, start_revision in zip(key_ranges, start_revisions):
                 if isinstance(r, (str, bytes)):
                     key, range_end = ensure_bytes(r), ''
                 else:
@@ -307,22 +950,46 @@ class WatchSection(ClientSection):
                 await stream.send_message(pb2.WatchRequest(
                     create_request=pb2.WatchCreateRequest(
                         key=ensure_bytes(key),
-                        range_end=ensure_bytes(range_end))))
+                        range_end=ensure_bytes(range_end),
+                        start_revision=start_revision,
+                        **create_args)))
 
-            watch_id: int = 0
-            while self.client.is_alive():
-                try:
-                    resp = await stream.recv_message()
-                except StreamTerminatedError:
-                    logger.warning('stream watching terminated %s', stream)
-                    break
-                if resp.created:
-                    watch_id = resp.watch_id
-                elif resp.canceled:
-                    await stream.send_request(end=True)
-                    break
-                else:
-                    yield resp
+            watchdog: Optional[ProgressWatchdog] = None
+            if progress_timeout:
+                watchdog = ProgressWatchdog(stream, progress_timeout)
+            try:
+                # created responses come in the order of create requests
+                indexes: Dict[int, int] = {}
+                assembler = FragmentAssembler()
+                while self.client.is_alive():
+                    if watchdog is not None:
+                        resp = await watchdog.recv()
+                    else:
+                        resp = await stream.recv_message()
+                    if resp is None:
+                        # raised to leave the stream without ending it,
+                        # an error status of the server is raised as
+                        # GRPCError instead
+                        raise StreamTerminatedError('stream ended by server')
+                    resp = assembler.feed(resp)
+                    if resp is None:
+                        # more fragments to come
+                        continue
+                    if resp.created:
+                        indexes[resp.watch_id] = len(indexes)
+                    i = indexes.get(resp.watch_id, -1)
+                    if resp.canceled:
+                        if resp.compact_revision:
+                            raise WatchCompacted(resp.compact_revision,
+                                                 resp.cancel_reason)
+                        logger.info('watch %s canceled, %s',
+                                    resp.watch_id, resp.cancel_reason)
+                        break
+                    yield i, resp
+                await stream.cancel()
+            finally:
+                if watchdog is not None:
+                    watchdog.stop()
 
 class ClusterSection(ClientSection):
     stub_cls = ClusterStub
@@ -332,3 +999,41 @@ class ClusterSection(ClientSection):
         resp = await self.stub.MemberList(
             pb2.MemberListRequest())
         return resp.members
+
+class MaintenanceSection(ClientSection):
+    stub_cls = MaintenanceStub
+
+    @section_retry()
+    async def status(self) -> pb2.StatusResponse:
+        return await self.stub.Status(pb2.StatusRequest())
+
+    async def probe(self, server_url: str,
+                    timeout: Optional[float]=None
+    ) -> Optional[pb2.StatusResponse]:
+        '''
+        Request the status of the given server, the latency and health
+        of the server are recorded by the balancer.
+
+        :return: the status or None if the server failed
+        '''
+        balancer = self.client.balancer
+        stub = self.client.get_endpoint(server_url).stub(self.stub_cls)
+        try:
+            resp = await stub.Status(pb2.StatusRequest(), timeout=timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            # the failure is recorded by the endpoint
+            logger.warning('probe etcd server %s failed, %s', server_url, e)
+            return None
+        except GRPCError as e:
+            # an error status, such as UNAVAILABLE when the server is
+            # stopping, is not seen by the endpoint
+            logger.warning('probe etcd server %s failed, %s', server_url, e)
+            balancer.mark_failure(server_url, e)
+            return None
+        stats = balancer.get_stats(server_url)
+        stats.probed_at = time.time()
+        balancer.set_leader(resp.leader, resp.raftTerm)
+        stats.is_learner = resp.isLearner
+        if resp.errors:
+            balancer.mark_failure(server_url, ', '.join(resp.errors))
+        return resp
@@ -0,0 +1,322 @@
+from typing import Any, Callable, Dict, List, Optional, Type, Tuple
+import time
+import asyncio
+import logging
+from random import choice
+from urllib.parse import urlparse
+
+from grpclib.client import Channel
+
+logger = logging.getLogger(__name__)
+
+def parse_server_url(server_url: str) -> Tuple[str, int]:
+    parsed = urlparse(server_url)
+    if ':' in parsed.netloc:
+        host, port = parsed.netloc.split(':')
+        return host, int(port)
+    else:
+        return parsed.netloc, 2379
+
+class ServerStats:
+    url: str
+    member_id: int = 0
+    is_learner: bool = False
+    latency: Optional[float] = None
+    healthy: bool = True
+    calls: int = 0
+    failures: int = 0
+    last_error: str = ''
+    probed_at: float = 0
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'member_id': self.member_id,
+            'is_learner': self.is_learner,
+            'latency': self.latency,
+            'healthy': self.healthy,
+            'calls': self.calls,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'probed_at': self.probed_at,
+        }
+
+class Balancer:
+    '''
+    Keeps the EWMA of rpc latency of each etcd server, which is fed
+    from every stub call and the status probes, and chooses the
+    fastest healthy server.
+
+    The leader is tracked by the raft term found in the headers of
+    responses, on_term_change is called when a newer term is seen and
+    the leader becomes unknown until set_leader() is called.
+    '''
+    decay: float
+    stats: Dict[str, ServerStats]
+    leader_id: int = 0
+    raft_term: int = 0
+    on_term_change: Optional[Callable[[int], None]] = None
+
+    def __init__(self, decay: float=0.3):
+        assert 0 < decay <= 1
+        self.decay = decay
+        self.stats = {}
+
+    def get_stats(self, url: str) -> ServerStats:
+        stats = self.stats.get(url)
+        if stats is None:
+            stats = ServerStats(url)
+            self.stats[url] = stats
+        return stats
+
+    def observe(self, url: str, latency: float) -> None:
+        stats = self.get_stats(url)
+        stats.calls += 1
+        stats.healthy = True
+        if stats.latency is None:
+            stats.latency = latency
+        else:
+            stats.latency += self.decay * (latency - stats.latency)
+
+    def observe_header(self, url: str, header: Any) -> None:
+        if header.member_id:
+            self.get_stats(url).member_id = header.member_id
+        if header.raft_term > self.raft_term:
+            if self.raft_term:
+                logger.info('raft term changed from %s to %s',
+                            self.raft_term, header.raft_term)
+            self.raft_term = header.raft_term
+            self.leader_id = 0
+            if self.on_term_change is not None:
+                self.on_term_change(header.raft_term)
+
+    def set_leader(self, leader_id: int, raft_term: int) -> None:
+        if raft_term >= self.raft_term:
+            self.raft_term = raft_term
+            self.leader_id = leader_id
+
+    def leader_url(self) -> Optional[str]:
+        '''
+        :return: the url of the leader or None if the leader is
+        unknown or failed
+        '''
+        if not self.leader_id:
+            return None
+        for stats in self.stats.values():
+            if stats.member_id == self.leader_id and stats.healthy:
+                return stats.url
+        return None
+
+    def mark_healthy(self, url: str) -> None:
+        self.get_stats(url).healthy = True
+
+    def mark_failure(self, url: str, error: Any) -> None:
+        stats = self.get_stats(url)
+        stats.healthy = False
+        stats.failures += 1
+        stats.last_error = str(error)
+
+    def choose(self, urls: List[str], allow_learner: bool=False) -> str:
+        '''
+        Choose the healthy server with the lowest latency, servers not
+        measured yet are chosen randomly.
+
+        :param allow_learner: learners only serve serializable reads,
+        they are excluded unless allowed
+        '''
+        assert urls
+        if not allow_learner:
+            voters = [url for url in urls
+                      if not self.get_stats(url).is_learner]
+            urls = voters or urls
+        candidates = [url for url in urls
+                      if self.get_stats(url).healthy]
+        if not candidates:
+            # all failed, try any of them
+            candidates = urls
+        measured = [url for url in candidates
+                    if self.get_stats(url).latency is not None]
+        if measured:
+            return min(measured, key=lambda url: self.stats[url].latency)
+        return choice(candidates)
+
+    def scoreboard(self) -> List[Dict[str, Any]]:
+        board = []
+        for stats in sorted(self.stats.values(),
+                            key=lambda s: (not s.healthy,
+                                           s.latency is None,
+                                           s.latency or 0)):
+            d = stats.as_dict()
+            d['leader'] = bool(self.leader_id
+                               and stats.member_id == self.leader_id)
+            board.append(d)
+        return board
+
+class Connection:
+    '''
+    One grpc channel, aka one HTTP/2 connection, of an endpoint.
+    '''
+    index: int
+    channel: Channel
+    inflight: int = 0
+    _stubs: Dict[Type, Any]
+
+    def __init__(self, index: int, channel: Channel):
+        self.index = index
+        self.channel = channel
+        self._stubs = {}
+
+    def stub(self, stub_cls: Type) -> Any:
+        stub = self._stubs.get(stub_cls)
+        if stub is None:
+            stub = stub_cls(self.channel)
+            self._stubs[stub_cls] = stub
+        return stub
+
+class Endpoint:
+    '''
+    A pool of grpc channels connected to one etcd server and the
+    stubs built on them, stubs are created once and reused by every
+    call, each call is dispatched to the channel with the fewest
+    requests in flight.
+    '''
+    url: str
+    connections: List[Connection]
+    inflight: int = 0
+    retired: bool = False
+    balancer: Optional[Balancer] = None
+    _stubs: Dict[Type, Any]
+
+    def __init__(self, url: str, pool_size: int=1,
+                 balancer: Optional[Balancer]=None,
+                 **channel_args):
+        assert pool_size >= 1, 'pool size must be positive'
+        self.url = url
+        self.balancer = balancer
+        host, port = parse_server_url(url)
+        # TODO: handle ssl
+        self.connections = [
+            Connection(i, Channel(host, port, **channel_args))
+            for i in range(pool_size)]
+        self._stubs = {}
+
+    @property
+    def channel(self) -> Channel:
+        return self.connections[0].channel
+
+    def stub(self, stub_cls: Type) -> Any:
+        stub = self._stubs.get(stub_cls)
+        if stub is None:
+            stub = _Stub(self, stub_cls)
+            self._stubs[stub_cls] = stub
+        return stub
+
+    def acquire(self) -> Connection:
+        '''
+        Pick the connection with the fewest requests in flight
+        '''
+        conn = self.connections[0]
+        if len(self.connections) > 1:
+            for c in self.connections:
+                if c.inflight < conn.inflight:
+                    conn = c
+        conn.inflight += 1
+        self.inflight += 1
+        return conn
+
+    def release(self, conn: Connection) -> None:
+        conn.inflight -= 1
+        self.inflight -= 1
+        if self.retired and self.inflight <= 0:
+            self.close()
+
+    def observe(self, latency: float) -> None:
+        if self.balancer is not None:
+            self.balancer.observe(self.url, latency)
+
+    def observe_header(self, header: Any) -> None:
+        if self.balancer is not None:
+            self.balancer.observe_header(self.url, header)
+
+    def fail(self, error: Exception) -> None:
+        if self.balancer is not None:
+            self.balancer.mark_failure(self.url, error)
+
+    def retire(self) -> None:
+        '''
+        Stop using the endpoint, the channels are closed once the
+        requests in flight are drained.
+        '''
+        self.retired = True
+        if self.inflight <= 0:
+            self.close()
+
+    def close(self) -> None:
+        logger.debug('close channels to %s', self.url)
+        for conn in self.connections:
+            conn.channel.close()
+
+class _Stub:
+    '''
+    Wraps every method of a generated stub, so that calls are spread
+    over the connections of the endpoint.
+    '''
+    def __init__(self, endpoint: Endpoint, stub_cls: Type):
+        stubs = [conn.stub(stub_cls) for conn in endpoint.connections]
+        for name in vars(stubs[0]):
+            setattr(self, name, _Method(
+                endpoint,
+                [getattr(stub, name) for stub in stubs]))
+
+class _Method:
+    def __init__(self, endpoint: Endpoint, methods: List[Any]):
+        self.endpoint = endpoint
+        self.methods = methods
+
+    async def __call__(self, request: Any, **kwargs) -> Any:
+        endpoint = self.endpoint
+        conn = endpoint.acquire()
+        start = time.monotonic()
+        try:
+            resp = await self.methods[conn.index](request, **kwargs)
+        except (OSError, asyncio.TimeoutError) as e:
+            endpoint.fail(e)
+            raise
+        finally:
+            endpoint.release(conn)
+        endpoint.observe(time.monotonic() - start)
+        header = getattr(resp, 'header', None)
+        if header is not None:
+            endpoint.observe_header(header)
+        return resp
+
+    def open(self, **kwargs) -> '_StreamContext':
+        return _StreamContext(self, kwargs)
+
+class _StreamContext:
+    conn: Optional[Connection] = None
+
+    def __init__(self, method: _Method, kwargs: Dict[str, Any]):
+        self.method = method
+        self.kwargs = kwargs
+
+    async def __aenter__(self) -> Any:
+        endpoint = self.method.endpoint
+        self.conn = endpoint.acquire()
+        try:
+            self.stream = self.method.methods[self.conn.index].open(
+                **self.kwargs)
+            return await self.stream.__aenter__()
+        except BaseException:
+            endpoint.release(self.conn)
+            raise
+
+    async def __aexit__(self, *exc_info) -> Any:
+        assert self.conn is not None
+        try:
+            return await self.stream.__aexit__(*exc_info)
+        finally:
+            self.method.endpoint.release(self.conn)
@@ -0,0 +1,242 @@
+from typing import Union, Optional, Any, List, Dict, TYPE_CHECKING
+from collections import deque, OrderedDict
+import logging
+import asyncio
+
+from aioetcdm3.pb.mvccpb import kv_pb2
+
+from .utils import ensure_bytes
+
+if TYPE_CHECKING:
+    from .client import Client
+
+logger = logging.getLogger(__name__)
+
+# overflow policies of a subscriber
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+class SubscriberOverflow(Exception):
+    '''
+    The subscriber fell behind and is disconnected, the events queued
+    are dropped and the watched keys must be resynced
+    '''
+    revision: int
+
+    def __init__(self, revision: int):
+        super().__init__(revision)
+        self.revision = revision
+
+class Subscriber:
+    '''
+    The events of a WatchHub for one consumer, queued up to maxsize.
+    When the queue is full, by policy
+      drop_oldest: the oldest event is dropped
+      coalesce: the queue keeps the newest event of each key only, and
+        disconnects once maxsize keys are queued
+      disconnect: the subscriber is disconnected, iterating it raises
+        SubscriberOverflow
+
+    A disconnected subscriber is not resynced by the hub, the caller
+    reads the keys again and subscribes again.
+    '''
+    maxsize: int
+    policy: str
+    # the mod_revision of the last event iterated
+    revision: int = 0
+    delivered: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+    closed: bool = False
+    _hub: 'WatchHub'
+    _queue: Any
+    _error: Optional[Exception] = None
+    _ready: asyncio.Event
+
+    def __init__(self, hub: 'WatchHub', maxsize: int, policy: str):
+        assert policy in POLICIES, f'unknown policy {policy}'
+        assert maxsize >= 1
+        self._hub = hub
+        self.maxsize = maxsize
+        self.policy = policy
+        if policy == COALESCE:
+            self._queue = OrderedDict()
+        else:
+            self._queue = deque()
+        self._ready = asyncio.Event()
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'policy': self.policy,
+            'depth': len(self._queue),
+            'maxsize': self.maxsize,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+    def close(self) -> None:
+        self._hub.unsubscribe(self)
+
+    def __aiter__(self) -> 'Subscriber':
+        return self
+
+    async def __anext__(self) -> kv_pb2.Event:
+        while not self._queue:
+            if self._error is not None:
+                raise self._error
+            if self.closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        if self.policy == COALESCE:
+            _, event = self._queue.popitem(last=False)
+        else:
+            event = self._queue.popleft()
+        self.delivered += 1
+        self.revision = event.kv.mod_revision
+        return event
+
+    def _put(self, event: kv_pb2.Event) -> None:
+        if self.closed:
+            return
+        if self.policy == COALESCE:
+            key = event.kv.key
+            if key in self._queue:
+                # keep the newest one at the position of its revision
+                del self._queue[key]
+                self.coalesced += 1
+            elif len(self._queue) >= self.maxsize:
+                self._disconnect()
+                return
+            self._queue[key] = event
+        else:
+            if len(self._queue) >= self.maxsize:
+                if self.policy == DISCONNECT:
+                    self._disconnect()
+                    return
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(event)
+        self._ready.set()
+
+    def _disconnect(self) -> None:
+        logger.warning('subscriber of %s overflowed at revision %s',
+                       self._hub.key, self.revision)
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self._hub.unsubscribe(self, SubscriberOverflow(self.revision))
+
+    def _finish(self, error: Optional[Exception]=None) -> None:
+        self.closed = True
+        self._error = error
+        self._ready.set()
+
+class WatchHub:
+    '''
+    Broadcasts the events of one watch to many subscribers, the events
+    are put to the bounded queue of each subscriber without waiting,
+    so a slow subscriber never stalls the watch nor the others.
+
+    The watch is started on the first subscription and resumed when
+    broken, a compacted watch finishes all subscribers with
+    WatchCompacted, then the next subscription starts the watch again
+    from now.
+    '''
+    client: 'Client'
+    key: bytes
+    range_end: bytes
+    start_revision: int
+    progress_timeout: Optional[float]
+    prev_kv: bool
+    revision: int = 0
+    events: int = 0
+    _subscribers: List[Subscriber]
+    _task: Optional[asyncio.Future] = None
+    _closed: bool = False
+
+    def __init__(self, client: 'Client',
+                 key: Union[bytes, str],
+                 range_end: Union[bytes, str]=b'',
+                 start_revision: int=0,
+                 progress_timeout: Optional[float]=None,
+                 prev_kv: bool=False):
+        self.client = client
+        self.key = ensure_bytes(key)
+        self.range_end = ensure_bytes(range_end)
+        self.start_revision = start_revision
+        self.progress_timeout = progress_timeout
+        self.prev_kv = prev_kv
+        self._subscribers = []
+
+    def subscribe(self, maxsize: int=1000,
+                  policy: str=DROP_OLDEST) -> Subscriber:
+        '''
+        :param maxsize: the max events queued for the subscriber
+        :param policy: drop_oldest, coalesce or disconnect, what to do
+        when the queue is full
+        :return: the subscriber receives the events after the watch is
+        started
+        '''
+        assert not self._closed, 'hub is closed'
+        sub = Subscriber(self, maxsize, policy)
+        self._subscribers.append(sub)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+        return sub
+
+    def unsubscribe(self, sub: Subscriber,
+                    error: Optional[Exception]=None) -> None:
+        if sub in self._subscribers:
+            self._subscribers.remove(sub)
+        sub._finish(error)
+
+    def close(self) -> None:
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+        for sub in self._subscribers:
+            sub._finish()
+        self._subscribers = []
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [sub.depth() for sub in self._subscribers]
+        return {
+            'subscribers': len(self._subscribers),
+            'revision': self.revision,
+            'events': self.events,
+            'max_depth': max(depths, default=0),
+            'total_depth': sum(depths),
+        }
+
+    async def _watch(self) -> None:
+        try:
+            async for resp in self.client.watch.keep_watching(
+                    (self.key, self.range_end),
+                    start_revision=self.start_revision,
+                    progress_notify=True,
+                    progress_timeout=self.progress_timeout,
+                    prev_kv=self.prev_kv):
+                if self._closed:
+                    break
+                for event in resp.events:
+                    self.events += 1
+                    for sub in list(self._subscribers):
+                        sub._put(event)
+                self.revision = max(self.revision, resp.header.revision)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('watching %s failed, %s', self.key, e)
+            # the revision may be compacted, the next subscription
+            # watches from now
+            self.start_revision = 0
+            for sub in list(self._subscribers):
+                self.unsubscribe(sub, e)
+        finally:
+            self._task = None
@@ -0,0 +1,456 @@
+from typing import (Union, Optional, Any, List, Dict, Tuple,
+                    Callable, Awaitable, Mapping, TYPE_CHECKING)
+import time
+import heapq
+import random
+import logging
+import asyncio
+
+from grpclib.exceptions import GRPCError, StreamTerminatedError
+
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+
+from .utils import ensure_bytes
+from .batch import MAX_TXN_OPS
+
+if TYPE_CHECKING:
+    from .client import Client
+
+logger = logging.getLogger(__name__)
+
+LeaseCallback = Callable[['Lease'], Awaitable[Any]]
+
+class Lease:
+    '''
+    A lease kept alive by a LeaseKeeper, whose remaining TTL is tracked
+    locally from the keep alive responses, so the expiry is noticed in
+    time even when no response comes.
+
+    The near expiry callbacks are called when the lease is not
+    refreshed until near_expiry seconds before it expires, the expire
+    callbacks when it expires or the server reports it expired.
+    '''
+    lease_id: int
+    ttl: int
+    near_expiry: float
+    expires_at: float
+    expired: bool = False
+    # the least remaining seconds when the lease was refreshed
+    min_margin: Optional[float] = None
+    _keeper: 'LeaseKeeper'
+    _expire_callbacks: List[LeaseCallback]
+    _near_expiry_callbacks: List[LeaseCallback]
+    _timers: List[asyncio.TimerHandle]
+
+    def __init__(self, keeper: 'LeaseKeeper', lease_id: int, ttl: int,
+                 near_expiry: Optional[float]=None):
+        '''
+        :param ttl: the TTL granted, which is counted from now
+        :param near_expiry: seconds before the expiry to call the near
+        expiry callbacks, 1/3 of the TTL by default
+        '''
+        self._keeper = keeper
+        self.lease_id = lease_id
+        self.ttl = ttl
+        self.near_expiry = ttl / 3 if near_expiry is None else near_expiry
+        self.expires_at = time.time() + ttl
+        self._expire_callbacks = []
+        self._near_expiry_callbacks = []
+        self._timers = []
+        self._arm()
+
+    def remaining(self) -> float:
+        '''
+        The seconds before the lease expires
+        '''
+        return max(0, self.expires_at - time.time())
+
+    def on_expire(self, callback: LeaseCallback) -> None:
+        self._expire_callbacks.append(callback)
+
+    def on_near_expiry(self, callback: LeaseCallback) -> None:
+        self._near_expiry_callbacks.append(callback)
+
+    def close(self) -> None:
+        '''
+        Stop keeping the lease alive by this object
+        '''
+        self._disarm()
+        self._keeper._remove(self)
+
+    def _arm(self) -> None:
+        self._disarm()
+        loop = asyncio.get_event_loop()
+        remaining = self.remaining()
+        if remaining > self.near_expiry:
+            self._timers.append(loop.call_later(
+                remaining - self.near_expiry,
+                self._call, self._near_expiry_callbacks))
+        self._timers.append(loop.call_later(remaining, self._expire))
+
+    def _disarm(self) -> None:
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+
+    def _refreshed(self, ttl: int) -> None:
+        now = time.time()
+        margin = max(0, self.expires_at - now)
+        if self.min_margin is None or margin < self.min_margin:
+            self.min_margin = margin
+        self.expires_at = now + ttl
+        self._arm()
+
+    def _expire(self) -> None:
+        if self.expired:
+            return
+        logger.warning('lease %s expired', self.lease_id)
+        self.expired = True
+        self.close()
+        self._call(self._expire_callbacks)
+
+    def _call(self, callbacks: List[LeaseCallback]) -> None:
+        for callback in callbacks:
+            asyncio.ensure_future(callback(self))
+
+class LeaseKeeper:
+    '''
+    Keeps all the registered leases alive over one LeaseKeepAlive
+    stream, leases can be registered and unregistered at any time.
+    The keep alives are sent and the responses received by separate
+    tasks, the stream is reopened when broken.
+
+    Each lease is refreshed at refresh_ratio of the TTL in its last
+    response, randomized by jitter so that the leases granted together
+    are not refreshed in bursts, the refreshes are scheduled in a heap.
+    A lease without response is refreshed again after retry_interval,
+    and the stream is reopened to another server if nothing is received
+    since the last refresh of it.
+    '''
+    client: 'Client'
+    refresh_ratio: float
+    jitter: float
+    retry_interval: float
+    sent: int = 0
+    received: int = 0
+    # how late the refreshes are sent than scheduled
+    lag_max: float = 0
+    lag_total: float = 0
+    # the least remaining seconds of a Lease when refreshed
+    min_margin: Optional[float] = None
+    # the TTL of each lease from the last response
+    ttls: Dict[int, int]
+    _leases: Dict[int, int]
+    _due: Dict[int, float]
+    _objects: Dict[int, List[Lease]]
+    # the time of the keep alives sent and not yet responded
+    _unanswered: Dict[int, float]
+    _last_received: float = 0
+    _schedule: List[Tuple[float, int]]
+    _wakeup: asyncio.Event
+    _task: Optional[asyncio.Future] = None
+    _closed: bool = False
+
+    def __init__(self, client: 'Client',
+                 refresh_ratio: float=1/3,
+                 jitter: float=0.1,
+                 retry_interval: float=1):
+        '''
+        :param refresh_ratio: refresh a lease after the ratio of its TTL
+        :param jitter: the max ratio of the refresh delay randomized
+        :param retry_interval: seconds to refresh again a lease whose
+        keep alive is not responded
+        '''
+        assert 0 < refresh_ratio < 1
+        self.client = client
+        self.refresh_ratio = refresh_ratio
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.ttls = {}
+        # the registration count of each lease
+        self._leases = {}
+        # the time to refresh each lease, the heap entries not equal to
+        # it are stale
+        self._due = {}
+        self._schedule = []
+        self._objects = {}
+        self._unanswered = {}
+        self._wakeup = asyncio.Event()
+
+    def register(self, lease_id: int) -> None:
+        assert not self._closed, 'keeper is closed'
+        count = self._leases.get(lease_id, 0)
+        self._leases[lease_id] = count + 1
+        if not count:
+            self._reschedule(lease_id, time.time())
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._keep_streaming())
+
+    def keep(self, lease_id: int, ttl: int,
+             near_expiry: Optional[float]=None) -> Lease:
+        '''
+        Register the lease and track its expiry
+
+        :param ttl: the TTL granted to the lease
+        :return: the lease object, closing it unregisters the lease
+        '''
+        lease = Lease(self, lease_id, ttl, near_expiry=near_expiry)
+        self._objects.setdefault(lease_id, []).append(lease)
+        self.register(lease_id)
+        return lease
+
+    def min_remaining(self) -> Optional[float]:
+        '''
+        The least remaining seconds of the kept Lease objects
+        '''
+        return min((lease.remaining()
+                    for leases in self._objects.values()
+                    for lease in leases), default=None)
+
+    def _remove(self, lease: Lease) -> None:
+        leases = self._objects.get(lease.lease_id, [])
+        if lease in leases:
+            leases.remove(lease)
+            if not leases:
+                del self._objects[lease.lease_id]
+            self.unregister(lease.lease_id)
+
+    def unregister(self, lease_id: int) -> None:
+        '''
+        Stop keeping the lease alive once every registration of it is
+        unregistered
+        '''
+        count = self._leases.get(lease_id, 0) - 1
+        if count > 0:
+            self._leases[lease_id] = count
+        else:
+            self._leases.pop(lease_id, None)
+            self._due.pop(lease_id, None)
+            self._unanswered.pop(lease_id, None)
+            self.ttls.pop(lease_id, None)
+
+    def close(self) -> None:
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+        self._leases = {}
+        self._due = {}
+        self._schedule = []
+        for leases in self._objects.values():
+            for lease in leases:
+                lease._disarm()
+        self._objects = {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'leases': len(self._leases),
+            'sent': self.sent,
+            'received': self.received,
+            'lag_max': self.lag_max,
+            'lag_avg': self.lag_total / self.sent if self.sent else 0,
+            'min_margin': self.min_margin,
+            'min_remaining': self.min_remaining(),
+        }
+
+    def _reschedule(self, lease_id: int, due: float) -> None:
+        self._due[lease_id] = due
+        heapq.heappush(self._schedule, (due, lease_id))
+        if self._schedule[0][1] == lease_id:
+            # the earliest one is changed
+            self._wakeup.set()
+
+    def _next_refresh(self, ttl: int) -> float:
+        delay = ttl * self.refresh_ratio
+        delay += delay * random.uniform(-self.jitter, self.jitter)
+        return time.time() + delay
+
+    async def _keep_streaming(self) -> None:
+        while not self._closed and self.client.is_alive():
+            try:
+                await self._stream()
+                continue
+            except (OSError, StreamTerminatedError, GRPCError) as e:
+                # GRPCError such as UNAVAILABLE when the server has no
+                # leader
+                logger.warning('lease keep alive stream failed, %s', e)
+            except Exception:
+                # the leases of the whole process depend on the keeper
+                logger.exception('lease keep alive stream failed')
+            self.client.select_server()
+            # retry sooner than the leases expire
+            remaining = self.min_remaining()
+            await asyncio.sleep(1 if remaining is None
+                                else min(1, remaining / 4))
+
+    async def _stream(self) -> None:
+        async with self.client.lease.stub.LeaseKeepAlive.open() as stream:
+            # the headers must be sent before receiving
+            await stream.send_request()
+            # the keep alives might be lost with the last stream
+            now = time.time()
+            self._last_received = now
+            self._unanswered = {}
+            for lease_id in self._due:
+                self._reschedule(lease_id, now)
+            tasks = [asyncio.ensure_future(self._send_keep_alives(stream)),
+                     asyncio.ensure_future(self._recv_responses(stream))]
+            try:
+                # either fails first, the other is canceled
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # retrieve the errors of the canceled ones
+                await asyncio.gather(*tasks, return_exceptions=True)
+            # the client is closed
+            await stream.cancel()
+
+    async def _send_keep_alives(self, stream: Any) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._schedule:
+                await self._wakeup.wait()
+                continue
+            due, lease_id = self._schedule[0]
+            if self._due.get(lease_id) != due:
+                heapq.heappop(self._schedule)
+                continue
+            now = time.time()
+            if due > now:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._schedule)
+            sent_at = self._unanswered.get(lease_id)
+            if sent_at is not None and self._last_received < sent_at:
+                # the stream is reopened to another server
+                raise StreamTerminatedError(
+                    f'no keep alive response in {now - sent_at:.1f} seconds')
+            self._unanswered[lease_id] = now
+            # retry unless responded
+            self._reschedule(lease_id, now + self.retry_interval)
+            await stream.send_message(
+                pb2.LeaseKeepAliveRequest(ID=lease_id))
+            self.sent += 1
+            lag = now - due
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+
+    async def _recv_responses(self, stream: Any) -> None:
+        while not self._closed and self.client.is_alive():
+            resp = await stream.recv_message()
+            if resp is None:
+                # raised to leave the stream without ending it, an
+                # error status of the server is raised as GRPCError
+                raise StreamTerminatedError('lease keep alive stream ended')
+            self.received += 1
+            self._last_received = time.time()
+            self._unanswered.pop(resp.ID, None)
+            if resp.ID not in self._leases:
+                continue
+            self.ttls[resp.ID] = resp.TTL
+            if resp.TTL <= 0:
+                logger.warning('lease %s expired', resp.ID)
+                self._due.pop(resp.ID, None)
+                for lease in list(self._objects.get(resp.ID, [])):
+                    lease._expire()
+            else:
+                self._reschedule(resp.ID, self._next_refresh(resp.TTL))
+                for lease in self._objects.get(resp.ID, []):
+                    lease._refreshed(resp.TTL)
+                    if (self.min_margin is None
+                        or lease.min_margin < self.min_margin):
+                        self.min_margin = lease.min_margin
+
+class LeaseKeys:
+    '''
+    Keys attached to one lease, e.g. the registration of a service. The
+    lease is granted and then all keys are put in one Txn, which takes
+    two round trips instead of one per key. The lease is kept alive by
+    the keeper of the client, and granted and written again when it
+    expires.
+    '''
+    client: 'Client'
+    ttl: int
+    kvs: Dict[bytes, bytes]
+    lease: Optional[Lease] = None
+    # the times the keys are written again after expired
+    recreated: int = 0
+    _task: Optional[asyncio.Future] = None
+    _closed: bool = False
+
+    def __init__(self, client: 'Client',
+                 kvs: Mapping[Union[bytes, str], Union[bytes, str]],
+                 ttl: int):
+        assert 0 < len(kvs) <= MAX_TXN_OPS, \
+            f'1 to {MAX_TXN_OPS} keys are written in one txn'
+        self.client = client
+        self.ttl = ttl
+        self.kvs = {ensure_bytes(k): ensure_bytes(v) for k, v in kvs.items()}
+
+    @property
+    def lease_id(self) -> int:
+        return self.lease.lease_id if self.lease is not None else 0
+
+    async def start(self) -> None:
+        '''
+        Grant the lease and write the keys
+        '''
+        await self._create()
+
+    async def close(self, revoke: bool=True) -> None:
+        '''
+        :param revoke: revoke the lease, which deletes the keys now
+        instead of when it expires
+        '''
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+        lease, self.lease = self.lease, None
+        if lease is not None:
+            lease.close()
+            if revoke and not lease.expired:
+                await self.client.lease.revoke(lease.lease_id)
+
+    async def _create(self) -> None:
+        grant = await self.client.lease.grant(self.ttl)
+        try:
+            await self.client.kv.txn(success=[
+                pb2.RequestOp(
+                    request_put=pb2.PutRequest(
+                        key=key,
+                        value=value,
+                        lease=grant.ID))
+                for key, value in self.kvs.items()])
+        except Exception:
+            # not to leak a lease on each retry
+            try:
+                await self.client.lease.revoke(grant.ID)
+            except Exception as e:
+                logger.warning('revoking lease %s failed, %s', grant.ID, e)
+            raise
+        lease = self.client.lease.keeper.keep(grant.ID, grant.TTL)
+        lease.on_expire(self._on_expire)
+        self.lease = lease
+        logger.info('%s keys attached to lease %s', len(self.kvs), grant.ID)
+
+    async def _on_expire(self, lease: Lease) -> None:
+        if self._closed or lease is not self.lease:
+            return
+        self._task = asyncio.ensure_future(self._recreate())
+
+    async def _recreate(self) -> None:
+        while not self._closed and self.client.is_alive():
+            try:
+                await self._create()
+                self.recreated += 1
+                return
+            except Exception as e:
+                logger.warning('recreating lease of %s keys failed, %s',
+                               len(self.kvs), e)
+                await asyncio.sleep(1)
@@ -1,5 +1,5 @@
 import asyncio
-from typing import Union
+from typing import Union, List, Tuple
 
 def ensure_bytes(v: Union[bytes, str], encoding: str='utf8') -> bytes:
     if not isinstance(v, bytes):
@@ -17,3 +17,34 @@ def prefix_range_end(prefix: Union[bytes, str]) -> bytes:
             break
     return bytes(s)
 
+def split_range(start: Union[bytes, str],
+                end: Union[bytes, str],
+                n: int) -> List[Tuple[bytes, bytes]]:
+    """Split the key range [start, end) into at most n sub ranges at
+    byte boundaries, the keys are treated as big endian numbers one
+    byte longer than the longer of start and end, so the sub ranges
+    are of equal size in the key space but not necessarily in number
+    of keys."""
+    start = ensure_bytes(start)
+    end = ensure_bytes(end)
+    if n <= 1 or not end:
+        return [(start, end)]
+
+    # range_end b'\0' means all keys >= start
+    open_end = end == b'\0'
+    width = max(len(start), 0 if open_end else len(end)) + 1
+    lo = int.from_bytes(start.ljust(width, b'\0'), 'big')
+    if open_end:
+        hi = 1 << (8 * width)
+    else:
+        hi = int.from_bytes(end.ljust(width, b'\0'), 'big')
+    if hi - lo < n:
+        return [(start, end)]
+
+    keys = [start]
+    for i in range(1, n):
+        key = (lo + (hi - lo) * i // n).to_bytes(width, 'big')
+        if key > keys[-1]:
+            keys.append(key)
+    keys.append(end)
+    return list(zip(keys[:-1], keys[1:]))
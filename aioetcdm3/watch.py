@@ -0,0 +1,572 @@
+from typing import (Union, Optional, Any, List, Dict, Deque, Tuple,
+                    AsyncIterator, TYPE_CHECKING)
+from collections import deque, OrderedDict
+import time
+import logging
+import asyncio
+from asyncio import Queue
+
+from grpclib.exceptions import GRPCError, StreamTerminatedError
+
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.mvccpb import kv_pb2
+
+from .utils import ensure_bytes
+
+if TYPE_CHECKING:
+    from .client import Client
+
+logger = logging.getLogger(__name__)
+
+class WatchCanceled(Exception):
+    '''
+    The watch is canceled by the server
+    '''
+
+class WatchCompacted(WatchCanceled):
+    '''
+    The revision to watch from is compacted, the events since then
+    are lost and the watched keys must be resynced
+    '''
+    compact_revision: int
+
+    def __init__(self, compact_revision: int, reason: str=''):
+        super().__init__(compact_revision, reason)
+        self.compact_revision = compact_revision
+
+class WatchFragmentOverflow(Exception):
+    '''
+    The fragments of a watch response exceed the buffer limit, the
+    events are dropped and the watched keys must be resynced
+    '''
+
+# the default limit of buffered fragments of a watch response
+MAX_FRAGMENT_BYTES = 64 * 1024 * 1024
+
+def watch_create_args(progress_notify: bool=False,
+                      no_put: bool=False,
+                      no_delete: bool=False,
+                      prev_kv: bool=False,
+                      fragment: bool=False) -> Dict[str, Any]:
+    '''
+    :return: the options of WatchCreateRequest
+    '''
+    filters = []
+    if no_put:
+        filters.append(pb2.WatchCreateRequest.FilterType.NOPUT)
+    if no_delete:
+        filters.append(pb2.WatchCreateRequest.FilterType.NODELETE)
+    return {
+        'progress_notify': progress_notify,
+        'filters': filters,
+        'prev_kv': prev_kv,
+        'fragment': fragment,
+    }
+
+class FragmentAssembler:
+    '''
+    Merges the fragments of a large watch response into one, the
+    fragments of each watch are buffered apart and at most max_bytes
+    of them are buffered for a watch.
+    '''
+    max_bytes: int
+    _buffers: Dict[int, Tuple[pb2.WatchResponse, int]]
+
+    def __init__(self, max_bytes: int=MAX_FRAGMENT_BYTES):
+        self.max_bytes = max_bytes
+        self._buffers = {}
+
+    def feed(self, resp: pb2.WatchResponse) -> Optional[pb2.WatchResponse]:
+        '''
+        :return: the whole response or None if more fragments follow
+        :raise WatchFragmentOverflow: the buffered fragments are too
+        large, which are dropped
+        '''
+        buffered = self._buffers.pop(resp.watch_id, None)
+        if buffered is None:
+            if not resp.fragment:
+                return resp
+            merged, size = pb2.WatchResponse(), 0
+            merged.CopyFrom(resp)
+        else:
+            merged, size = buffered
+            merged.events.extend(resp.events)
+        size += resp.ByteSize()
+        if size > self.max_bytes:
+            raise WatchFragmentOverflow(
+                f'fragments of watch {resp.watch_id} exceed '
+                f'{self.max_bytes} bytes')
+        if resp.fragment:
+            self._buffers[resp.watch_id] = (merged, size)
+            return None
+        merged.fragment = False
+        return merged
+
+def is_progress(resp: pb2.WatchResponse) -> bool:
+    '''
+    Whether the response is a progress notification, all events up to
+    its header.revision have been sent
+    '''
+    return not (resp.events or resp.created or resp.canceled)
+
+class ProgressWatchdog:
+    '''
+    Receives from a watch stream, requests progress when nothing is
+    received within the timeout, and ends the stream as dead when
+    still nothing is received within another timeout, which detects a
+    dead stream much faster than TCP does.
+    '''
+    stream: Any
+    timeout: float
+    _receiving: Optional[asyncio.Future] = None
+
+    def __init__(self, stream: Any, timeout: float):
+        self.stream = stream
+        self.timeout = timeout
+
+    async def recv(self) -> Optional[pb2.WatchResponse]:
+        '''
+        :return: the next response or None when the stream is ended
+        :raise StreamTerminatedError: nothing is received in twice the
+        timeout
+        '''
+        if self._receiving is None:
+            # kept across timeouts, cancelling a receive in the middle
+            # of a message would corrupt the stream
+            self._receiving = asyncio.ensure_future(
+                self.stream.recv_message())
+        receiving = self._receiving
+        done, _ = await asyncio.wait([receiving], timeout=self.timeout)
+        if not done:
+            # quiet for a while, ask the server for progress
+            try:
+                await asyncio.wait_for(
+                    self.stream.send_message(pb2.WatchRequest(
+                        progress_request=pb2.WatchProgressRequest())),
+                    self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                done, _ = await asyncio.wait([receiving],
+                                             timeout=self.timeout)
+        if not done:
+            self.stop()
+            raise StreamTerminatedError(
+                f'no progress of watch stream in {self.timeout * 2} seconds')
+        self._receiving = None
+        return receiving.result()
+
+    def stop(self) -> None:
+        if self._receiving is not None:
+            self._receiving.cancel()
+            self._receiving = None
+
+class Watcher:
+    '''
+    A watch created over the shared stream of a WatchMultiplexer, the
+    watch responses are iterated by `async for`, which stops when the
+    watch is canceled.
+    '''
+    watch_id: int = -1
+    key: bytes
+    range_end: bytes
+    create_args: Dict[str, Any]
+    next_revision: int
+    canceled: bool = False
+    _mux: 'WatchMultiplexer'
+    _queue: Queue
+    _created: asyncio.Event
+
+    def __init__(self, mux: 'WatchMultiplexer',
+                 key: bytes,
+                 range_end: bytes,
+                 start_revision: int,
+                 create_args: Dict[str, Any]):
+        self._mux = mux
+        self.key = key
+        self.range_end = range_end
+        self.create_args = create_args
+        # the revision to create the watch from, 0 means now
+        self.next_revision = start_revision
+        self._queue = Queue()
+        self._created = asyncio.Event()
+
+    def create_request(self) -> pb2.WatchRequest:
+        return pb2.WatchRequest(
+            create_request=pb2.WatchCreateRequest(
+                key=self.key,
+                range_end=self.range_end,
+                start_revision=self.next_revision,
+                **self.create_args))
+
+    async def wait_created(self) -> None:
+        '''
+        Wait until the watch is created, events after then are not
+        missed
+        '''
+        await self._created.wait()
+
+    async def cancel(self) -> None:
+        self._mux.cancel(self)
+
+    def __aiter__(self) -> 'Watcher':
+        return self
+
+    async def __anext__(self) -> pb2.WatchResponse:
+        item = await self._queue.get()
+        if item is None:
+            # put back for the other waiters
+            self._queue.put_nowait(None)
+            raise StopAsyncIteration
+        elif isinstance(item, Exception):
+            self._queue.put_nowait(None)
+            raise item
+        return item
+
+    def _deliver(self, resp: pb2.WatchResponse) -> None:
+        if resp.events:
+            self.next_revision = resp.events[-1].kv.mod_revision + 1
+        elif is_progress(resp):
+            self.next_revision = max(self.next_revision,
+                                     resp.header.revision + 1)
+        self._queue.put_nowait(resp)
+
+    def _finish(self, error: Optional[Exception]=None) -> None:
+        self.canceled = True
+        self._queue.put_nowait(error)
+
+class WatchMultiplexer:
+    '''
+    Creates many watches over one Watch stream, the responses are
+    routed to the watchers by watch_id. The stream is opened on the
+    first watch and reopened when broken, the watchers are created
+    again on the new stream from the revision after the last
+    delivered one, so no event is lost.
+
+    With progress_timeout set, progress is requested from a quiet
+    stream and the stream is reopened if nothing is received in time.
+    '''
+    client: 'Client'
+    progress_timeout: Optional[float]
+    max_fragment_bytes: int
+    _active: List[Watcher]
+    _watchers: Dict[int, Watcher]
+    _pending: Deque[Watcher]
+    _requests: Optional[Queue] = None
+    _task: Optional[asyncio.Future] = None
+    _closed: bool = False
+
+    def __init__(self, client: 'Client',
+                 progress_timeout: Optional[float]=None,
+                 max_fragment_bytes: int=MAX_FRAGMENT_BYTES):
+        self.client = client
+        self.progress_timeout = progress_timeout
+        self.max_fragment_bytes = max_fragment_bytes
+        self._active = []
+        self._watchers = {}
+        self._pending = deque()
+
+    def watch(self,
+              key: Union[bytes, str],
+              range_end: Union[bytes, str]=b'',
+              start_revision: int=0,
+              progress_notify: bool=False,
+              no_put: bool=False,
+              no_delete: bool=False,
+              prev_kv: bool=False,
+              fragment: bool=False) -> Watcher:
+        '''
+        :param progress_notify: the server sends empty responses
+        periodically to a quiet watch, which advance its revision
+        :param no_put, no_delete: filter out the put or delete events
+        at server side
+        :param prev_kv: the events carry the key value before them
+        :param fragment: large responses are split by the server and
+        merged before delivered
+        :return: the watcher of [key, range_end), the watch is created
+        in background
+        '''
+        assert not self._closed, 'multiplexer is closed'
+        watcher = Watcher(self, ensure_bytes(key),
+                          ensure_bytes(range_end),
+                          start_revision,
+                          watch_create_args(progress_notify=progress_notify,
+                                            no_put=no_put,
+                                            no_delete=no_delete,
+                                            prev_kv=prev_kv,
+                                            fragment=fragment))
+        self._active.append(watcher)
+        if self._requests is not None:
+            self._requests.put_nowait(
+                (watcher.create_request(), watcher))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._keep_streaming())
+        return watcher
+
+    def cancel(self, watcher: Watcher) -> None:
+        self._cancel(watcher)
+
+    def _cancel(self, watcher: Watcher,
+                error: Optional[Exception]=None) -> None:
+        if watcher.canceled:
+            return
+        if watcher in self._active:
+            self._active.remove(watcher)
+        if watcher.watch_id >= 0 and self._requests is not None:
+            self._requests.put_nowait(
+                (pb2.WatchRequest(
+                    cancel_request=pb2.WatchCancelRequest(
+                        watch_id=watcher.watch_id)),
+                 None))
+        # a pending watcher is canceled once created
+        watcher._finish(error)
+
+    def request_progress(self) -> None:
+        '''
+        Request a progress notification to all watchers of the stream
+        '''
+        if self._requests is not None:
+            self._requests.put_nowait(
+                (pb2.WatchRequest(
+                    progress_request=pb2.WatchProgressRequest()),
+                 None))
+
+    def close(self) -> None:
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+        for watcher in self._active:
+            watcher._finish()
+        self._active = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'watchers': len(self._active),
+            'created': len(self._watchers),
+            'pending': len(self._pending),
+        }
+
+    async def _keep_streaming(self) -> None:
+        while not self._closed and self.client.is_alive():
+            try:
+                await self._stream()
+            except (OSError, StreamTerminatedError, GRPCError) as e:
+                logger.warning('watch stream failed, %s', e)
+                self.client.select_server()
+                await asyncio.sleep(1)
+            except Exception as e:
+                # not to recover, end the watchers instead of leaving
+                # them waiting
+                logger.exception('watch stream failed')
+                self._task = None
+                for watcher in self._active:
+                    watcher._finish(e)
+                self._active = []
+                return
+
+    async def _stream(self) -> None:
+        async with self.client.watch.stub.Watch.open() as stream:
+            # the headers must be sent before receiving
+            await stream.send_request()
+            # watch ids are scoped in a stream, create all again
+            self._watchers = {}
+            self._pending = deque()
+            requests: Queue = Queue()
+            for watcher in self._active:
+                watcher.watch_id = -1
+                requests.put_nowait((watcher.create_request(), watcher))
+            self._requests = requests
+            send_task = asyncio.ensure_future(
+                self._send_requests(stream, requests))
+            watchdog: Optional[ProgressWatchdog] = None
+            if self.progress_timeout:
+                watchdog = ProgressWatchdog(stream, self.progress_timeout)
+            try:
+                await self._recv_responses(stream, watchdog)
+            finally:
+                self._requests = None
+                send_task.cancel()
+                if watchdog is not None:
+                    watchdog.stop()
+
+    async def _send_requests(self, stream: Any, requests: Queue) -> None:
+        while True:
+            req, watcher = await requests.get()
+            if watcher is not None:
+                # created responses come in the order of requests
+                self._pending.append(watcher)
+            await stream.send_message(req)
+
+    async def _recv_responses(self, stream: Any,
+                              watchdog: Optional[ProgressWatchdog]) -> None:
+        assembler = FragmentAssembler(self.max_fragment_bytes)
+        while not self._closed and self.client.is_alive():
+            if watchdog is not None:
+                resp = await watchdog.recv()
+            else:
+                resp = await stream.recv_message()
+            if resp is None:
+                # raised to leave the stream without ending it
+                raise StreamTerminatedError('watch stream ended')
+            try:
+                resp = assembler.feed(resp)
+            except WatchFragmentOverflow as e:
+                watcher = self._watchers.get(resp.watch_id)
+                if watcher is not None:
+                    logger.warning('%s, cancel the watch', e)
+                    del self._watchers[resp.watch_id]
+                    self._cancel(watcher, e)
+                continue
+            if resp is None:
+                continue
+            if resp.created:
+                self._on_created(resp)
+                continue
+            if resp.watch_id < 0 and is_progress(resp):
+                # the response of a progress request is for all
+                for watcher in list(self._watchers.values()):
+                    watcher._deliver(resp)
+                continue
+            watcher = self._watchers.get(resp.watch_id)
+            if watcher is None:
+                continue
+            elif resp.canceled:
+                del self._watchers[resp.watch_id]
+                self._on_canceled(watcher, resp)
+            else:
+                watcher._deliver(resp)
+        # the client is closed
+        await stream.cancel()
+
+    def _on_created(self, resp: pb2.WatchResponse) -> None:
+        if not self._pending:
+            logger.warning('unexpected created watch %s', resp.watch_id)
+            return
+        watcher = self._pending.popleft()
+        watcher.watch_id = resp.watch_id
+        if resp.canceled:
+            # failed to create
+            self._on_canceled(watcher, resp)
+            return
+        self._watchers[resp.watch_id] = watcher
+        if not watcher.next_revision:
+            watcher.next_revision = resp.header.revision + 1
+        watcher._created.set()
+        if watcher.canceled and self._requests is not None:
+            self._requests.put_nowait(
+                (pb2.WatchRequest(
+                    cancel_request=pb2.WatchCancelRequest(
+                        watch_id=watcher.watch_id)),
+                 None))
+
+    def _on_canceled(self, watcher: Watcher,
+                     resp: pb2.WatchResponse) -> None:
+        if watcher in self._active:
+            self._active.remove(watcher)
+        if not watcher.canceled:
+            logger.info('watch %s canceled, %s',
+                        resp.watch_id, resp.cancel_reason)
+            if resp.compact_revision:
+                watcher._finish(WatchCompacted(resp.compact_revision,
+                                               resp.cancel_reason))
+            else:
+                watcher._finish(WatchCanceled(resp.cancel_reason))
+
+class EventCoalescer:
+    '''
+    Merges the events of watch responses by key, only the last event
+    of each key is emitted, for keys whose latest value is all that
+    matters. The responses are read in background as they come, the
+    events received meanwhile are emitted as one list in revision
+    order on each iteration.
+
+    With window set, a list is emitted window seconds after its first
+    event, so the events in the window are merged too. The pending
+    events are bounded by the number of distinct keys.
+    '''
+    window: float
+    received: int = 0
+    emitted: int = 0
+    _responses: AsyncIterator[pb2.WatchResponse]
+    _pending: 'OrderedDict[bytes, kv_pb2.Event]'
+    _first_at: float = 0
+    _ready: asyncio.Event
+    _task: Optional[asyncio.Future] = None
+    _error: Optional[Exception] = None
+    _done: bool = False
+
+    def __init__(self, responses: AsyncIterator[pb2.WatchResponse],
+                 window: float=0):
+        '''
+        :param responses: the watch responses, e.g. from keep_watching()
+        or a multiplexed watcher
+        :param window: seconds to merge events for, 0 means to emit
+        the pending events at once
+        '''
+        self._responses = responses
+        self.window = window
+        self._pending = OrderedDict()
+        self._ready = asyncio.Event()
+
+    @property
+    def elided(self) -> int:
+        '''
+        The number of events merged away
+        '''
+        return self.received - self.emitted - len(self._pending)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'received': self.received,
+            'emitted': self.emitted,
+            'elided': self.elided,
+            'pending': len(self._pending),
+        }
+
+    def close(self) -> None:
+        self._done = True
+        if self._task is not None:
+            self._task.cancel()
+        self._ready.set()
+
+    def __aiter__(self) -> 'EventCoalescer':
+        return self
+
+    async def __anext__(self) -> List[kv_pb2.Event]:
+        if self._task is None and not self._done:
+            self._task = asyncio.ensure_future(self._read())
+        while not self._pending:
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        if self.window > 0 and not self._done:
+            delay = self._first_at + self.window - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        events = list(self._pending.values())
+        self._pending = OrderedDict()
+        self.emitted += len(events)
+        return events
+
+    async def _read(self) -> None:
+        try:
+            async for resp in self._responses:
+                for event in resp.events:
+                    if not self._pending:
+                        self._first_at = time.time()
+                    # move the key to the end, the order of revisions
+                    self._pending.pop(event.kv.key, None)
+                    self._pending[event.kv.key] = event
+                    self.received += 1
+                if self._pending:
+                    self._ready.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._ready.set()
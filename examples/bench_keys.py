@@ -0,0 +1,62 @@
+import time
+import asyncio
+import argparse
+from aioetcdm3.client import Client
+from aioetcdm3.utils import prefix_range_end
+
+async def read_pages(c: Client, prefix: str, **kwargs) -> None:
+    start = time.perf_counter()
+    n = 0
+    size = 0
+    async for resp in c.kv.iter_pages(prefix, prefix_range_end(prefix),
+                                      **kwargs):
+        n += len(resp.kvs)
+        size += resp.ByteSize()
+    used = time.perf_counter() - start
+    print(f'{kwargs}: {n} keys, {size} bytes, {used * 1000:.1f} ms')
+
+async def main() -> None:
+    # parse arguments
+    parser = argparse.ArgumentParser(description='compare full range reads with keys only and count only reads')
+    parser.add_argument('-n',
+                        type=int,
+                        default=10000,
+                        help='keys to put')
+    parser.add_argument('--value-size',
+                        type=int,
+                        default=1024,
+                        help='bytes of each value')
+    parser.add_argument('--prefix',
+                        type=str,
+                        default='/bench_keys/',
+                        help='the prefix of keys')
+    parser.add_argument('--etcd',
+                        type=str,
+                        default='http://127.0.0.1:2379',
+                        help='etcd server url')
+    args = parser.parse_args()
+
+    c = Client(args.etcd)
+    value = 'v' * args.value_size
+    for i in range(args.n):
+        await c.kv.put(f'{args.prefix}{i:08d}', value)
+
+    await read_pages(c, args.prefix)
+    await read_pages(c, args.prefix, keys_only=True)
+
+    start = time.perf_counter()
+    count = await c.kv.count(args.prefix)
+    used = time.perf_counter() - start
+    print(f'count only: {count} keys, {used * 1000:.1f} ms')
+
+    await c.kv.delete_range(args.prefix, prefix_range_end(args.prefix))
+    c.close()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
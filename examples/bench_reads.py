@@ -0,0 +1,58 @@
+import time
+import asyncio
+import argparse
+from aioetcdm3.client import Client
+
+async def run_gets(c: Client, key: str, consistency: str,
+                   concurrency: int, n: int) -> None:
+    async def worker() -> None:
+        for _ in range(n):
+            await c.kv.get(key, consistency=consistency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    used = time.perf_counter() - start
+    total = concurrency * n
+    print(f'{consistency}: {total / used:.0f} gets/s, '
+          f'{used * 1e6 / n:.0f} us/get')
+
+async def main() -> None:
+    # parse arguments
+    parser = argparse.ArgumentParser(description='compare the throughput of linearizable and serializable reads')
+    parser.add_argument('-n',
+                        type=int,
+                        default=1000,
+                        help='gets of each worker')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=32,
+                        help='concurrent workers')
+    parser.add_argument('--pool-size',
+                        type=int,
+                        default=1,
+                        help='connections to each server')
+    parser.add_argument('--key',
+                        type=str,
+                        default='bench_reads',
+                        help='the key to get')
+    parser.add_argument('--etcd',
+                        type=str,
+                        default='http://127.0.0.1:2379',
+                        help='etcd server url')
+    args = parser.parse_args()
+
+    c = Client(args.etcd, pool_size=args.pool_size)
+    await c.kv.put(args.key, 'value')
+
+    for consistency in ('linearizable', 'serializable'):
+        await run_gets(c, args.key, consistency, args.concurrency, args.n)
+    c.close()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
@@ -0,0 +1,51 @@
+import time
+import asyncio
+import argparse
+from aioetcdm3.client import Client
+from aioetcdm3.pb.etcdserverpb.rpc_grpc import KVStub
+
+def bench(title: str, func, n: int) -> None:
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    used = time.perf_counter() - start
+    print(f'{title}: {used * 1e9 / n:.0f} ns/call')
+
+async def main() -> None:
+    # parse arguments
+    parser = argparse.ArgumentParser(description='measure the per call overhead of stubs')
+    parser.add_argument('-n',
+                        type=int,
+                        default=100000,
+                        help='times to call')
+    parser.add_argument('--gets',
+                        type=int,
+                        default=0,
+                        help='also run gets against the etcd server')
+    parser.add_argument('--etcd',
+                        type=str,
+                        default='http://127.0.0.1:2379',
+                        help='etcd server url')
+    args = parser.parse_args()
+
+    c = Client(args.etcd)
+
+    bench('new stub per call', lambda: KVStub(c.channel), args.n)
+    bench('cached stub', lambda: c.kv.stub, args.n)
+
+    if args.gets > 0:
+        start = time.perf_counter()
+        for _ in range(args.gets):
+            await c.kv.get('bench_stub')
+        used = time.perf_counter() - start
+        print(f'kv.get: {used * 1e6 / args.gets:.0f} us/call')
+    c.close()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
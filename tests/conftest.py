@@ -0,0 +1,123 @@
+import socket
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+from grpclib import GRPCError, Status
+from grpclib.server import Server
+from aioetcdm3.client import Client
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.etcdserverpb.rpc_grpc import WatchBase, KVBase
+from aioetcdm3.pb.mvccpb import kv_pb2
+
+@pytest.fixture
+def etcd_client():
+    return Client('http://127.0.0.1')
+
+@asynccontextmanager
+async def fake_server(*handlers):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = Server(list(handlers))
+    await server.start('127.0.0.1', port)
+    try:
+        yield Client(f'http://127.0.0.1:{port}')
+    finally:
+        server.close()
+        await server.wait_closed()
+
+HANG = object()
+
+class FakeWatch(WatchBase):
+    '''
+    Serve each Watch stream by the next script in turn, a script is
+    the list of responses to send after the create request.
+    '''
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+        self.create_requests = []
+
+    async def Watch(self, stream):
+        req = await stream.recv_message()
+        self.create_requests.append(req.create_request)
+        for resp in self.scripts.pop(0):
+            if resp is HANG:
+                # a dead stream, which sends nothing more
+                await asyncio.sleep(3600)
+            await stream.send_message(resp)
+        # end the stream as a broken connection
+
+def created(revision):
+    return pb2.WatchResponse(
+        header=pb2.ResponseHeader(revision=revision),
+        watch_id=0, created=True)
+
+def put_event(key, revision):
+    return pb2.WatchResponse(
+        header=pb2.ResponseHeader(revision=revision),
+        watch_id=0,
+        events=[kv_pb2.Event(
+            type=kv_pb2.Event.EventType.PUT,
+            kv=kv_pb2.KeyValue(key=key, value=b'v',
+                               mod_revision=revision))])
+
+def progress(revision, watch_id=0):
+    return pb2.WatchResponse(
+        header=pb2.ResponseHeader(revision=revision),
+        watch_id=watch_id)
+
+def fragment(resp):
+    resp.fragment = True
+    return resp
+
+class FakeKV(KVBase):
+    '''
+    Keep the keys in memory, a txn putting the key b'bad' fails as a
+    whole like one with an invalid op.
+    '''
+    def __init__(self):
+        self.revision = 1
+        self.kvs = {}
+        self.txns = []
+
+    def header(self):
+        return pb2.ResponseHeader(revision=self.revision)
+
+    async def Range(self, stream):
+        req = await stream.recv_message()
+        kvs = [self.kvs[req.key]] if req.key in self.kvs else []
+        await stream.send_message(pb2.RangeResponse(
+            header=self.header(), kvs=kvs, count=len(kvs)))
+
+    async def Txn(self, stream):
+        req = await stream.recv_message()
+        self.txns.append(req)
+        if any(op.request_put.key == b'bad' for op in req.success):
+            raise GRPCError(Status.INVALID_ARGUMENT, 'bad key')
+        self.revision += 1
+        responses = []
+        for op in req.success:
+            if op.HasField('request_put'):
+                put = op.request_put
+                self.kvs[put.key] = kv_pb2.KeyValue(
+                    key=put.key, value=put.value,
+                    mod_revision=self.revision)
+                responses.append(pb2.ResponseOp(
+                    response_put=pb2.PutResponse(header=self.header())))
+            else:
+                key = op.request_delete_range.key
+                deleted = int(self.kvs.pop(key, None) is not None)
+                responses.append(pb2.ResponseOp(
+                    response_delete_range=pb2.DeleteRangeResponse(
+                        header=self.header(), deleted=deleted)))
+        await stream.send_message(pb2.TxnResponse(
+            header=self.header(), succeeded=True, responses=responses))
+
+    async def Put(self, stream):
+        pass
+
+    async def DeleteRange(self, stream):
+        pass
+
+    async def Compact(self, stream):
+        pass
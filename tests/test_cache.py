@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from aioetcdm3.cache import CachedKV, PrefixMirror
+from aioetcdm3.utils import ensure_bytes, prefix_range_end
+from aioetcdm3.pb.mvccpb import kv_pb2
+from .conftest import fake_server, FakeKV
+
+@pytest.mark.asyncio
+async def test_cached_kv(etcd_client):
+    c = etcd_client
+    await c.kv.delete_range('cache/', prefix_range_end(b'cache/'))
+    for i in range(5):
+        await c.kv.put(f'cache/{i}', f'ok{i}')
+
+    cache = CachedKV(c, 'cache/')
+    await cache.start()
+    try:
+        assert await cache.get('cache/1') == b'ok1'
+        assert await cache.get('cache/9') is None
+        assert cache.stats()['hits'] == 2
+
+        await c.kv.put('cache/1', 'changed')
+        await c.kv.delete('cache/2')
+        await asyncio.sleep(0.5)
+        assert await cache.get('cache/1') == b'changed'
+        assert await cache.get('cache/2') is None
+
+        resp = await cache.get_range('cache/', prefix_range_end(b'cache/'))
+        assert [kv.key for kv in resp.kvs] == [
+            ensure_bytes(f'cache/{i}') for i in (0, 1, 3, 4)]
+        assert resp.header.revision == cache.revision
+    finally:
+        cache.close()
+
+@pytest.mark.asyncio
+async def test_cached_kv_evicted(etcd_client):
+    c = etcd_client
+    await c.kv.delete_range('cache/', prefix_range_end(b'cache/'))
+    for i in range(5):
+        await c.kv.put(f'cache/{i}', f'ok{i}')
+
+    cache = CachedKV(c, 'cache/', max_keys=2)
+    await cache.start()
+    try:
+        assert cache.stats()['keys'] == 2
+        assert cache.stats()['complete'] is False
+        # not cached, read from the cluster
+        assert await cache.get('cache/4') == b'ok4'
+        assert cache.stats()['misses'] == 1
+    finally:
+        cache.close()
+
+@pytest.mark.asyncio
+async def test_cached_kv_stale_read():
+    fake = FakeKV()
+    fake.kvs[b'cache/a'] = kv_pb2.KeyValue(
+        key=b'cache/a', value=b'old', mod_revision=3)
+    fake.revision = 5
+    async with fake_server(fake) as c:
+        cache = CachedKV(c, 'cache/')
+        # the cache is current to a revision newer than the read
+        cache._synced = True
+        cache.revision = 8
+        assert await cache.get('cache/a') == b'old'
+        assert cache.stats()['keys'] == 0
+
+        fake.revision = 8
+        assert await cache.get('cache/a') == b'old'
+        assert cache.stats()['keys'] == 1
+        c.close()
+
+@pytest.mark.asyncio
+async def test_prefix_mirror(etcd_client):
+    c = etcd_client
+    await c.kv.delete_range('mirror/', prefix_range_end(b'mirror/'))
+    for i in range(5):
+        await c.kv.put(f'mirror/{i}', f'ok{i}')
+
+    mirror = PrefixMirror(c, 'mirror/')
+    await mirror.start()
+    try:
+        assert len(mirror) == 5
+        kvs = mirror.range('mirror/1', 'mirror/3')
+        assert [kv.key for kv in kvs] == [b'mirror/1', b'mirror/2']
+
+        snapshot = mirror.snapshot()
+        await c.kv.put('mirror/10', 'new')
+        await c.kv.delete('mirror/0')
+        await asyncio.sleep(0.5)
+
+        assert [kv.key for kv in mirror.range('mirror/', '\0')] == [
+            b'mirror/1', b'mirror/10', b'mirror/2', b'mirror/3', b'mirror/4']
+        # the snapshot is not changed
+        assert [kv.key for kv in snapshot] == [
+            ensure_bytes(f'mirror/{i}') for i in range(5)]
+        assert mirror.get('mirror/10').value == b'new'
+    finally:
+        mirror.close()
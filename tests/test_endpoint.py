@@ -0,0 +1,253 @@
+import asyncio
+import pytest
+from grpclib import GRPCError, Status
+from aioetcdm3.endpoint import Balancer, Endpoint
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.etcdserverpb.rpc_grpc import (
+    MaintenanceBase, ClusterBase, KVStub, WatchStub)
+from .conftest import fake_server, FakeKV, FakeWatch, HANG, created
+
+def test_balancer_observe():
+    balancer = Balancer(decay=0.5)
+    balancer.mark_failure('http://a', 'refused')
+    balancer.observe('http://a', 0.1)
+    stats = balancer.get_stats('http://a')
+    assert stats.healthy
+    assert stats.latency == pytest.approx(0.1)
+
+    balancer.observe('http://a', 0.3)
+    assert stats.latency == pytest.approx(0.2)
+    assert stats.calls == 2
+    assert stats.failures == 1
+
+def test_balancer_choose():
+    balancer = Balancer()
+    urls = ['http://a', 'http://b', 'http://c']
+    balancer.observe('http://a', 0.1)
+    balancer.observe('http://b', 0.2)
+    balancer.observe('http://c', 0.3)
+    assert balancer.choose(urls) == 'http://a'
+
+    balancer.mark_failure('http://a', 'refused')
+    assert balancer.choose(urls) == 'http://b'
+
+    balancer.get_stats('http://b').is_learner = True
+    assert balancer.choose(urls) == 'http://c'
+    assert balancer.choose(urls, allow_learner=True) == 'http://b'
+
+    # all failed, the fastest voter is tried still
+    for url in urls:
+        balancer.mark_failure(url, 'refused')
+    assert balancer.choose(urls) == 'http://a'
+
+def test_balancer_scoreboard():
+    balancer = Balancer()
+    balancer.get_stats('http://new')
+    balancer.observe('http://slow', 0.3)
+    balancer.observe('http://fast', 0.1)
+    balancer.observe('http://failed', 0.01)
+    balancer.mark_failure('http://failed', 'refused')
+    assert [d['url'] for d in balancer.scoreboard()] == [
+        'http://fast', 'http://slow', 'http://new', 'http://failed']
+
+def test_balancer_term_change():
+    balancer = Balancer()
+    terms = []
+    balancer.on_term_change = terms.append
+    balancer.observe_header('http://a', pb2.ResponseHeader(
+        member_id=1, raft_term=2))
+    balancer.set_leader(1, 2)
+    assert balancer.leader_url() == 'http://a'
+
+    # an older term changes nothing
+    balancer.observe_header('http://b', pb2.ResponseHeader(
+        member_id=2, raft_term=1))
+    assert balancer.leader_url() == 'http://a'
+
+    balancer.observe_header('http://b', pb2.ResponseHeader(
+        member_id=2, raft_term=3))
+    assert balancer.leader_url() is None
+    assert terms == [2, 3]
+
+    # a stale status does not set the leader of an older term
+    balancer.set_leader(1, 2)
+    assert balancer.leader_url() is None
+    balancer.set_leader(2, 3)
+    assert balancer.leader_url() == 'http://b'
+
+    balancer.mark_failure('http://b', 'refused')
+    assert balancer.leader_url() is None
+
+class FakeMaintenance(MaintenanceBase):
+    '''
+    Report member 1 as the leader, or fail with UNAVAILABLE
+    '''
+    raft_term = 2
+    unavailable = False
+
+    async def Status(self, stream):
+        await stream.recv_message()
+        if self.unavailable:
+            raise GRPCError(Status.UNAVAILABLE, 'stopping')
+        await stream.send_message(pb2.StatusResponse(
+            header=pb2.ResponseHeader(member_id=1,
+                                      raft_term=self.raft_term),
+            leader=1, raftTerm=self.raft_term))
+
+    async def Alarm(self, stream):
+        pass
+
+    async def Defragment(self, stream):
+        pass
+
+    async def Hash(self, stream):
+        pass
+
+    async def HashKV(self, stream):
+        pass
+
+    async def Snapshot(self, stream):
+        pass
+
+    async def MoveLeader(self, stream):
+        pass
+
+    async def Downgrade(self, stream):
+        pass
+
+class FakeCluster(ClusterBase):
+    '''
+    A cluster of one member
+    '''
+    client_url = ''
+
+    async def MemberList(self, stream):
+        await stream.recv_message()
+        await stream.send_message(pb2.MemberListResponse(
+            members=[pb2.Member(ID=1, clientURLs=[self.client_url])]))
+
+    async def MemberAdd(self, stream):
+        pass
+
+    async def MemberRemove(self, stream):
+        pass
+
+    async def MemberUpdate(self, stream):
+        pass
+
+    async def MemberPromote(self, stream):
+        pass
+
+@pytest.mark.asyncio
+async def test_probe_error_status():
+    maintenance = FakeMaintenance()
+    maintenance.unavailable = True
+    async with fake_server(maintenance) as c:
+        server_url = c._current_server_url
+        assert await c.maintenance.probe(server_url) is None
+        stats = c.balancer.get_stats(server_url)
+        assert not stats.healthy
+        assert 'stopping' in stats.last_error
+        c.close()
+
+@pytest.mark.asyncio
+async def test_discover_leader():
+    maintenance = FakeMaintenance()
+    cluster = FakeCluster()
+    async with fake_server(maintenance, cluster) as c:
+        server_url = cluster.client_url = c._current_server_url
+        # unknown leader, the writes go to the current server
+        assert c.get_stub(KVStub, route='leader') is c.endpoint.stub(KVStub)
+
+        assert await c.discover_leader() == server_url
+        assert c.get_stub(KVStub, route='leader') is c.endpoint.stub(KVStub)
+
+        # a failed leader is routed to again once rediscovered
+        c.balancer.mark_failure(server_url, 'refused')
+        assert c.balancer.leader_url() is None
+        assert await c.discover_leader() == server_url
+
+        # a newer term found in a header starts the rediscovery
+        maintenance.raft_term = 3
+        c.balancer.observe_header(server_url, pb2.ResponseHeader(
+            member_id=1, raft_term=3))
+        assert c.balancer.leader_url() is None
+        await asyncio.wait_for(c._leader_task, 3)
+        assert c.balancer.leader_url() == server_url
+        assert c.balancer.raft_term == 3
+        c.close()
+
+class SlowKV(FakeKV):
+    '''
+    Range is answered once released
+    '''
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def Range(self, stream):
+        await self.released.wait()
+        await super().Range(stream)
+
+@pytest.mark.asyncio
+async def test_endpoint_least_inflight():
+    kv = SlowKV()
+    async with fake_server(kv) as c:
+        endpoint = Endpoint(c._current_server_url, pool_size=2,
+                            balancer=Balancer())
+        stub = endpoint.stub(KVStub)
+        calls = [
+            asyncio.ensure_future(stub.Range(pb2.RangeRequest(key=b'a')))
+            for _ in range(3)]
+        await asyncio.sleep(0.1)
+        assert endpoint.inflight == 3
+        assert sorted(conn.inflight for conn in endpoint.connections) == [1, 2]
+
+        kv.released.set()
+        await asyncio.gather(*calls)
+        assert endpoint.inflight == 0
+        assert [conn.inflight for conn in endpoint.connections] == [0, 0]
+        assert endpoint.balancer.get_stats(endpoint.url).calls == 3
+        endpoint.close()
+        c.close()
+
+@pytest.mark.asyncio
+async def test_endpoint_stream_inflight():
+    async with fake_server(FakeWatch([[created(1), HANG]])) as c:
+        endpoint = Endpoint(c._current_server_url)
+        async with endpoint.stub(WatchStub).Watch.open() as stream:
+            await stream.send_message(pb2.WatchRequest(
+                create_request=pb2.WatchCreateRequest(key=b'a')))
+            resp = await stream.recv_message()
+            assert resp.created
+            assert endpoint.inflight == 1
+            await stream.cancel()
+        assert endpoint.inflight == 0
+        endpoint.close()
+        c.close()
+
+@pytest.mark.asyncio
+async def test_endpoint_retire_drains():
+    kv = SlowKV()
+    async with fake_server(kv) as c:
+        endpoint = Endpoint(c._current_server_url)
+        closed = []
+        endpoint.close = lambda: closed.append(endpoint.inflight)
+        call = asyncio.ensure_future(
+            endpoint.stub(KVStub).Range(pb2.RangeRequest(key=b'a')))
+        await asyncio.sleep(0.1)
+        endpoint.retire()
+        assert closed == []
+
+        kv.released.set()
+        await call
+        assert closed == [0]
+
+        # an idle endpoint is closed at once
+        idle = Endpoint(c._current_server_url)
+        idle.close = lambda: closed.append(idle.inflight)
+        idle.retire()
+        assert closed == [0, 0]
+        Endpoint.close(endpoint)
+        Endpoint.close(idle)
+        c.close()
@@ -0,0 +1,45 @@
+import pytest
+from aioetcdm3.hub import (WatchHub, Subscriber, SubscriberOverflow,
+                           DROP_OLDEST, COALESCE, DISCONNECT)
+from aioetcdm3.pb.mvccpb import kv_pb2
+
+def put_event(key, revision):
+    return kv_pb2.Event(
+        type=kv_pb2.Event.EventType.PUT,
+        kv=kv_pb2.KeyValue(key=key, value=b'v', mod_revision=revision))
+
+async def drain(sub):
+    events = []
+    while sub.depth():
+        events.append(await sub.__anext__())
+    return [(ev.kv.key, ev.kv.mod_revision) for ev in events]
+
+@pytest.mark.asyncio
+async def test_subscriber_drop_oldest():
+    sub = Subscriber(WatchHub(None, 'a/'), 2, DROP_OLDEST)
+    for i, key in enumerate([b'a', b'b', b'a']):
+        sub._put(put_event(key, i + 1))
+    assert sub.stats()['dropped'] == 1
+    assert await drain(sub) == [(b'b', 2), (b'a', 3)]
+
+@pytest.mark.asyncio
+async def test_subscriber_coalesce():
+    sub = Subscriber(WatchHub(None, 'a/'), 2, COALESCE)
+    for i, key in enumerate([b'a', b'b', b'a']):
+        sub._put(put_event(key, i + 1))
+    assert sub.stats()['coalesced'] == 1
+    assert await drain(sub) == [(b'b', 2), (b'a', 3)]
+
+@pytest.mark.asyncio
+async def test_subscriber_disconnect():
+    hub = WatchHub(None, 'a/')
+    sub = Subscriber(hub, 1, DISCONNECT)
+    hub._subscribers.append(sub)
+    sub._put(put_event(b'a', 1))
+    assert await sub.__anext__()
+    sub._put(put_event(b'b', 2))
+    sub._put(put_event(b'c', 3))
+    assert hub.stats()['subscribers'] == 0
+    with pytest.raises(SubscriberOverflow) as excinfo:
+        await sub.__anext__()
+    assert excinfo.value.revision == 1
@@ -1,10 +1,10 @@
+import asyncio
 import pytest
+from grpclib import GRPCError
 from aioetcdm3.client import Client
-from aioetcdm3.utils import ensure_bytes, prefix_range_end
-
-@pytest.fixture
-def etcd_client():
-    return Client('http://127.0.0.1')
+from aioetcdm3.batch import WriteBatcher
+from aioetcdm3.utils import ensure_bytes, prefix_range_end, split_range
+from .conftest import fake_server, FakeKV
 
 @pytest.mark.asyncio
 async def test_put_get(etcd_client):
@@ -26,6 +26,113 @@ async def test_range_put_get(etcd_client):
     for i in range(5):
         assert resp.kvs[i].value == ensure_bytes(f'ok{i}')
 
+@pytest.mark.asyncio
+async def test_iter_range(etcd_client):
+    c = etcd_client
+    for i in range(5):
+        await c.kv.put(f'page{i}', f'ok{i}')
+
+    end = prefix_range_end(b'page')
+    kvs = [kv async for kv in c.kv.iter_range('page', end, page_size=2)]
+    assert [kv.key for kv in kvs] == [ensure_bytes(f'page{i}') for i in range(5)]
+    assert [kv.value for kv in kvs] == [ensure_bytes(f'ok{i}') for i in range(5)]
+
+@pytest.mark.asyncio
+async def test_scan(etcd_client):
+    c = etcd_client
+    for i in range(20):
+        await c.kv.put(f'scan{i:02d}', f'ok{i}')
+
+    end = prefix_range_end(b'scan')
+    kvs = [kv async for kv in c.kv.scan('scan', end, shards=4, page_size=3)]
+    assert [kv.key for kv in kvs] == [ensure_bytes(f'scan{i:02d}') for i in range(20)]
+
+    kvs = [kv async for kv in c.kv.scan('scan', end,
+                                        boundaries=['scan05', 'scan12'])]
+    assert [kv.key for kv in kvs] == [ensure_bytes(f'scan{i:02d}') for i in range(20)]
+
+@pytest.mark.asyncio
+async def test_count_keys(etcd_client):
+    c = etcd_client
+    await c.kv.delete_range('count', prefix_range_end(b'count'))
+    for i in range(5):
+        await c.kv.put(f'count{i}', f'ok{i}')
+
+    assert await c.kv.count('count') == 5
+    keys = [k async for k in c.kv.keys('count', page_size=2)]
+    assert keys == [ensure_bytes(f'count{i}') for i in range(5)]
+
+@pytest.mark.asyncio
+async def test_changes_since(etcd_client):
+    c = etcd_client
+    for i in range(5):
+        await c.kv.put(f'sync{i}', f'ok{i}')
+
+    kvs, revision = await c.kv.changes_since('sync', 0)
+    assert len(kvs) == 5
+
+    await c.kv.put('sync3', 'changed')
+    kvs, new_revision = await c.kv.changes_since('sync', revision)
+    assert [(kv.key, kv.value) for kv in kvs] == [(b'sync3', b'changed')]
+    assert new_revision > revision
+
+    assert await c.kv.get('sync3', revision=revision) == b'ok3'
+
+@pytest.mark.asyncio
+async def test_write_batcher(etcd_client):
+    c = etcd_client
+    batcher = WriteBatcher(c.kv, window=0.01)
+    resps = await asyncio.gather(*[
+        batcher.put(f'batch{i}', f'ok{i}') for i in range(10)])
+    assert len(resps) == 10
+    assert batcher.stats()['batches'] == 1
+
+    for i in range(10):
+        assert await c.kv.get(f'batch{i}') == ensure_bytes(f'ok{i}')
+
+    resps = await asyncio.gather(
+        batcher.put('batch0', 'again', prev_kv=True),
+        batcher.delete('batch1', prev_kv=True),
+        batcher.put('batch0', 'twice'))
+    assert resps[0].prev_kv.value == b'ok0'
+    assert resps[1].prev_kvs[0].value == b'ok1'
+    assert await c.kv.get('batch0') == b'twice'
+    assert await c.kv.get('batch1') is None
+
+@pytest.mark.asyncio
+async def test_write_batcher_order():
+    fake = FakeKV()
+    async with fake_server(fake) as c:
+        batcher = WriteBatcher(c.kv, window=0.01)
+        resps = await asyncio.gather(
+            batcher.put('k', 'a'),
+            batcher.put('bad', 'x'),
+            batcher.put('k', 'b'),
+            return_exceptions=True)
+        assert isinstance(resps[1], GRPCError)
+        assert fake.kvs[b'k'].value == b'b'
+        assert batcher.stats()['batches'] == 2
+        c.close()
+
+@pytest.mark.asyncio
+async def test_single_flight_get():
+    c = Client('http://127.0.0.1', single_flight=True)
+    await c.kv.put('flight', 'ok')
+
+    stats = c.kv.range_flight.stats()
+    values = await asyncio.gather(*[
+        c.kv.get('flight', consistency='serializable') for _ in range(10)])
+    assert values == [b'ok'] * 10
+
+    new_stats = c.kv.range_flight.stats()
+    assert new_stats['calls'] - stats['calls'] == 1
+    assert new_stats['merged'] - stats['merged'] == 9
+    assert new_stats['inflight'] == 0
+
+    # linearizable reads of the latest revision are not merged
+    await asyncio.gather(*[c.kv.get('flight') for _ in range(10)])
+    assert c.kv.range_flight.stats()['calls'] == new_stats['calls']
+
 @pytest.mark.asyncio
 async def test_put_w_prev(etcd_client):
     c = etcd_client
@@ -41,6 +148,18 @@ async def test_put_w_prev(etcd_client):
     succeed = await c.kv.put('hello', 'second', expect_prev_value=prev_v)
     assert succeed is True
 
+@pytest.mark.asyncio
+async def test_serializable_get(etcd_client):
+    c = etcd_client
+    await c.kv.put('hello', 'serial')
+
+    r = await c.kv.get('hello', consistency='serializable')
+    assert r == b'serial'
+
+    c = Client('http://127.0.0.1', consistency='serializable')
+    r = await c.kv.get('hello')
+    assert r == b'serial'
+
 
 @pytest.mark.asyncio
 async def test_delete(etcd_client):
@@ -71,5 +190,17 @@ async def test_prefix_range_end():
     assert prefix_range_end(b'ab\xff1\xff') == b'ab\xff2\xff'
     assert prefix_range_end(b'\xff\xff') == b'\xff\xff'
 
-
-
+@pytest.mark.asyncio
+async def test_split_range():
+    assert split_range(b'a', b'', 4) == [(b'a', b'')]
+    assert split_range(b'a', b'b', 1) == [(b'a', b'b')]
+
+    ranges = split_range(b'a', b'b', 4)
+    assert ranges == [(b'a', b'a@'), (b'a@', b'a\x80'),
+                      (b'a\x80', b'a\xc0'), (b'a\xc0', b'b')]
+
+    ranges = split_range(b'a', b'\0', 3)
+    assert ranges[0][0] == b'a'
+    assert ranges[-1][1] == b'\0'
+    for (s, e), (next_s, _) in zip(ranges, ranges[1:]):
+        assert s < e == next_s
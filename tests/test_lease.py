@@ -0,0 +1,171 @@
+import asyncio
+import pytest
+from grpclib import GRPCError, Status
+from aioetcdm3.lease import LeaseKeeper
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.etcdserverpb.rpc_grpc import LeaseBase, KVBase
+from .conftest import fake_server
+
+@pytest.mark.asyncio
+async def test_lease_keeper(etcd_client):
+    c = etcd_client
+    lease1 = await c.lease.grant(5)
+    lease2 = await c.lease.grant(5)
+    keeper = c.lease.keeper
+    keeper.register(lease1.ID)
+    keeper.register(lease2.ID)
+    await asyncio.sleep(1.5)
+    assert set(keeper.ttls) == {lease1.ID, lease2.ID}
+
+    # refreshed once granted, next after about 1/3 of the TTL
+    assert keeper.stats()['sent'] == 2
+
+    keeper.unregister(lease2.ID)
+    assert keeper.stats()['leases'] == 1
+    c.close()
+
+@pytest.mark.asyncio
+async def test_lease_expiry(etcd_client):
+    c = etcd_client
+    lease = await c.lease.grant(2)
+    kept = c.lease.keeper.keep(lease.ID, lease.TTL)
+    expired = asyncio.Event()
+
+    async def on_expire(l):
+        expired.set()
+    kept.on_expire(on_expire)
+
+    await asyncio.sleep(1.5)
+    assert not kept.expired
+    assert kept.remaining() > 1
+    assert kept.min_margin is not None
+
+    await c.lease.revoke(lease.ID)
+    await asyncio.wait_for(expired.wait(), 3)
+    assert kept.expired
+    c.close()
+
+@pytest.mark.asyncio
+async def test_lease_inspect(etcd_client):
+    c = etcd_client
+    lease = await c.lease.grant(10)
+    await c.kv.put('lease/a', 'ok', lease_id=lease.ID)
+
+    resp = await c.lease.time_to_live(lease.ID)
+    assert resp.grantedTTL == 10
+    assert resp.keys == [b'lease/a']
+
+    ids = [l.ID for l in (await c.lease.leases()).leases]
+    assert lease.ID in ids
+
+    resps = [resp async for resp in c.lease.inspect(concurrency=4)]
+    assert sorted(resp.ID for resp in resps) == sorted(ids)
+    await c.lease.revoke(lease.ID)
+
+@pytest.mark.asyncio
+async def test_lease_keys(etcd_client):
+    c = etcd_client
+    lease_keys = await c.lease.grant_keys(
+        {'service/a': 'addr1', 'service/b': 'addr2'}, 5)
+    assert await c.kv.get('service/a') == b'addr1'
+    resp = await c.lease.time_to_live(lease_keys.lease_id)
+    assert sorted(resp.keys) == [b'service/a', b'service/b']
+
+    await lease_keys.close()
+    assert await c.kv.get('service/b') is None
+    c.close()
+
+class FakeLease(LeaseBase):
+    '''
+    Answer the keep alives with ttl, the first silent_streams streams
+    answer nothing as dead ones
+    '''
+    def __init__(self, ttl, silent_streams=0):
+        self.ttl = ttl
+        self.silent_streams = silent_streams
+        self.streams = 0
+        self.keep_alives = 0
+        self.granted = []
+        self.revoked = []
+
+    async def LeaseKeepAlive(self, stream):
+        self.streams += 1
+        silent = self.streams <= self.silent_streams
+        async for req in stream:
+            self.keep_alives += 1
+            if not silent:
+                await stream.send_message(
+                    pb2.LeaseKeepAliveResponse(ID=req.ID, TTL=self.ttl))
+
+    async def LeaseGrant(self, stream):
+        req = await stream.recv_message()
+        self.granted.append(len(self.granted) + 1)
+        await stream.send_message(pb2.LeaseGrantResponse(
+            ID=self.granted[-1], TTL=req.TTL))
+
+    async def LeaseRevoke(self, stream):
+        req = await stream.recv_message()
+        self.revoked.append(req.ID)
+        await stream.send_message(pb2.LeaseRevokeResponse())
+
+    async def LeaseTimeToLive(self, stream):
+        pass
+
+    async def LeaseLeases(self, stream):
+        pass
+
+@pytest.mark.asyncio
+async def test_keep_alive_fake():
+    fake = FakeLease(ttl=6)
+    async with fake_server(fake) as c:
+        task = asyncio.ensure_future(c.lease.keep_alive(1, 2))
+        await asyncio.sleep(0.5)
+        assert c.lease.keeper.ttls == {1: 6, 2: 6}
+        task.cancel()
+        c.close()
+
+    assert fake.streams == 1
+    assert fake.keep_alives == 2
+
+@pytest.mark.asyncio
+async def test_keeper_reopens_silent_stream():
+    fake = FakeLease(ttl=3, silent_streams=1)
+    async with fake_server(fake) as c:
+        keeper = LeaseKeeper(c, retry_interval=0.2)
+        lease = keeper.keep(1, 3)
+        await asyncio.sleep(1.5)
+        assert fake.streams == 2
+        assert not lease.expired
+        assert lease.remaining() > 2
+        # refreshed with about 2 seconds left on the silent stream
+        assert 1.5 < lease.min_margin < 3
+        keeper.close()
+        c.close()
+
+class FailingKV(KVBase):
+    async def Txn(self, stream):
+        await stream.recv_message()
+        raise GRPCError(Status.INVALID_ARGUMENT, 'too many operations')
+
+    async def Range(self, stream):
+        pass
+
+    async def Put(self, stream):
+        pass
+
+    async def DeleteRange(self, stream):
+        pass
+
+    async def Compact(self, stream):
+        pass
+
+@pytest.mark.asyncio
+async def test_lease_keys_revoked_on_txn_failure():
+    fake = FakeLease(ttl=5)
+    async with fake_server(fake, FailingKV()) as c:
+        with pytest.raises(GRPCError):
+            await c.lease.grant_keys({'service/a': 'addr1'}, 5)
+        c.close()
+
+    assert fake.granted == [1]
+    assert fake.revoked == [1]
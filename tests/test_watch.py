@@ -0,0 +1,243 @@
+import asyncio
+import pytest
+from aioetcdm3.watch import (WatchCompacted, WatchFragmentOverflow,
+                             FragmentAssembler, EventCoalescer,
+                             WatchMultiplexer)
+from aioetcdm3.hub import WatchHub
+from aioetcdm3.utils import prefix_range_end
+from aioetcdm3.pb.etcdserverpb import rpc_pb2 as pb2
+from aioetcdm3.pb.mvccpb import kv_pb2
+from .conftest import (fake_server, FakeWatch, HANG, created, put_event,
+                       progress, fragment)
+
+@pytest.mark.asyncio
+async def test_multiplexer(etcd_client):
+    c = etcd_client
+    mux = c.watch.multiplexer()
+    w1 = mux.watch('mux/a')
+    w2 = mux.watch('mux/', prefix_range_end(b'mux/'))
+    await w1.wait_created()
+    await w2.wait_created()
+    assert w1.watch_id != w2.watch_id
+
+    await c.kv.put('mux/a', 'ok')
+    await c.kv.put('mux/b', 'ok')
+
+    resp = await asyncio.wait_for(w1.__anext__(), 3)
+    assert [ev.kv.key for ev in resp.events] == [b'mux/a']
+
+    keys = []
+    while len(keys) < 2:
+        resp = await asyncio.wait_for(w2.__anext__(), 3)
+        keys.extend(ev.kv.key for ev in resp.events)
+    assert keys == [b'mux/a', b'mux/b']
+
+    await w1.cancel()
+    assert [resp async for resp in w1] == []
+    assert mux.stats()['watchers'] == 1
+    mux.close()
+
+@pytest.mark.asyncio
+async def test_watch_filters(etcd_client):
+    c = etcd_client
+    await c.kv.put('filter/a', 'first')
+    mux = c.watch.multiplexer()
+    w = mux.watch('filter/a', no_put=True, prev_kv=True)
+    await w.wait_created()
+
+    await c.kv.put('filter/a', 'second')
+    await c.kv.delete('filter/a')
+
+    resp = await asyncio.wait_for(w.__anext__(), 3)
+    assert len(resp.events) == 1
+    event = resp.events[0]
+    assert event.type == kv_pb2.Event.EventType.DELETE
+    assert event.prev_kv.value == b'second'
+    mux.close()
+
+@pytest.mark.asyncio
+async def test_keep_watching_resumes():
+    fake = FakeWatch([
+        [created(5), put_event(b'a', 6)],
+        [created(9), put_event(b'a', 7), put_event(b'a', 8)],
+    ])
+    async with fake_server(fake) as c:
+        revisions = []
+        async for resp in c.watch.keep_watching('a'):
+            revisions.extend(ev.kv.mod_revision for ev in resp.events)
+            if len(revisions) == 3:
+                break
+        c.close()
+
+    assert revisions == [6, 7, 8]
+    assert [req.start_revision for req in fake.create_requests] == [0, 7]
+
+@pytest.mark.asyncio
+async def test_keep_watching_resumes_before_events():
+    fake = FakeWatch([
+        [created(5)],
+        [created(9), put_event(b'a', 6)],
+    ])
+    async with fake_server(fake) as c:
+        async for resp in c.watch.keep_watching('a'):
+            assert resp.events[0].kv.mod_revision == 6
+            break
+        c.close()
+
+    assert [req.start_revision for req in fake.create_requests] == [0, 6]
+
+@pytest.mark.asyncio
+async def test_keep_watching_backs_off():
+    # a server ending each stream right after created
+    fake = FakeWatch([[created(5)]] * 10)
+    async with fake_server(fake) as c:
+        async def watch():
+            async for resp in c.watch.keep_watching('a'):
+                pass
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(watch(), 0.5)
+        c.close()
+
+    assert len(fake.create_requests) == 1
+
+@pytest.mark.asyncio
+async def test_keep_watching_compacted():
+    fake = FakeWatch([
+        [created(5),
+         pb2.WatchResponse(watch_id=0, canceled=True, compact_revision=3,
+                           cancel_reason='compacted')],
+    ])
+    async with fake_server(fake) as c:
+        with pytest.raises(WatchCompacted) as excinfo:
+            async for resp in c.watch.keep_watching('a', start_revision=2):
+                pass
+        c.close()
+
+    assert excinfo.value.compact_revision == 3
+    assert fake.create_requests[0].start_revision == 2
+
+@pytest.mark.asyncio
+async def test_multiplexer_resumes():
+    fake = FakeWatch([
+        [created(5), put_event(b'a', 6)],
+        [created(9), put_event(b'a', 7)],
+    ])
+    async with fake_server(fake) as c:
+        watcher = c.watch.multiplexer().watch('a')
+        revisions = []
+        async for resp in watcher:
+            revisions.extend(ev.kv.mod_revision for ev in resp.events)
+            if len(revisions) == 2:
+                break
+        c.close()
+
+    assert revisions == [6, 7]
+    assert [req.start_revision for req in fake.create_requests] == [0, 7]
+
+@pytest.mark.asyncio
+async def test_keep_watching_progress():
+    fake = FakeWatch([
+        [created(5), progress(20), progress(30, watch_id=-1)],
+        [created(40), put_event(b'a', 41)],
+    ])
+    async with fake_server(fake) as c:
+        async for resp in c.watch.keep_watching('a', progress_notify=True):
+            if resp.events:
+                break
+        c.close()
+
+    assert fake.create_requests[0].progress_notify
+    assert [req.start_revision for req in fake.create_requests] == [0, 31]
+
+@pytest.mark.asyncio
+async def test_keep_watching_progress_timeout():
+    fake = FakeWatch([
+        [created(5), HANG],
+        [created(9), put_event(b'a', 6)],
+    ])
+    async with fake_server(fake) as c:
+        async def first_event():
+            async for resp in c.watch.keep_watching(
+                    'a', progress_timeout=0.2):
+                if resp.events:
+                    return resp.events[0].kv.mod_revision
+        # the dead stream is reopened after 2 timeouts
+        assert await asyncio.wait_for(first_event(), 3) == 6
+        c.close()
+
+    assert [req.start_revision for req in fake.create_requests] == [0, 6]
+
+@pytest.mark.asyncio
+async def test_multiplexer_progress_timeout():
+    fake = FakeWatch([
+        [created(5), HANG],
+        [created(9), put_event(b'a', 6)],
+    ])
+    async with fake_server(fake) as c:
+        mux = WatchMultiplexer(c, progress_timeout=0.2)
+        watcher = mux.watch('a')
+        resp = await asyncio.wait_for(watcher.__anext__(), 3)
+        assert resp.events[0].kv.mod_revision == 6
+        mux.close()
+        c.close()
+
+    assert [req.start_revision for req in fake.create_requests] == [0, 6]
+
+@pytest.mark.asyncio
+async def test_keep_watching_fragments():
+    fake = FakeWatch([
+        [created(5),
+         fragment(put_event(b'a', 6)),
+         fragment(put_event(b'b', 6)),
+         put_event(b'c', 6)],
+    ])
+    async with fake_server(fake) as c:
+        async for resp in c.watch.keep_watching('a', '\0', fragment=True):
+            keys = [ev.kv.key for ev in resp.events]
+            break
+        c.close()
+
+    assert fake.create_requests[0].fragment
+    assert keys == [b'a', b'b', b'c']
+
+def test_fragment_overflow():
+    assembler = FragmentAssembler(max_bytes=50)
+    with pytest.raises(WatchFragmentOverflow):
+        for _ in range(10):
+            assembler.feed(fragment(put_event(b'a', 6)))
+
+@pytest.mark.asyncio
+async def test_event_coalescer():
+    async def responses():
+        yield put_event(b'a', 1)
+        yield put_event(b'b', 2)
+        yield put_event(b'a', 3)
+
+    coalescer = EventCoalescer(responses(), window=0.1)
+    batches = [[(ev.kv.key, ev.kv.mod_revision) for ev in events]
+               async for events in coalescer]
+    assert batches == [[(b'b', 2), (b'a', 3)]]
+    assert coalescer.stats() == {
+        'received': 3, 'emitted': 2, 'elided': 1, 'pending': 0}
+
+@pytest.mark.asyncio
+async def test_hub_restarts_after_compacted():
+    fake = FakeWatch([
+        [created(5),
+         pb2.WatchResponse(watch_id=0, canceled=True, compact_revision=3,
+                           cancel_reason='compacted')],
+        [created(9), put_event(b'a', 10)],
+    ])
+    async with fake_server(fake) as c:
+        hub = WatchHub(c, 'a', start_revision=2)
+        sub = hub.subscribe()
+        with pytest.raises(WatchCompacted):
+            await asyncio.wait_for(sub.__anext__(), 3)
+
+        sub = hub.subscribe()
+        event = await asyncio.wait_for(sub.__anext__(), 3)
+        assert event.kv.mod_revision == 10
+        hub.close()
+        c.close()
+
+    assert [req.start_revision for req in fake.create_requests[:2]] == [2, 0]